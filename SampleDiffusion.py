@@ -1,6 +1,8 @@
 # Imports
 
 import subprocess, sys, os
+import time
+import base64
 import torch
 import random
 from pathlib import Path 
@@ -18,11 +20,12 @@ import k_diffusion
 import soundfile as sf
 import torchaudio
 from io import BytesIO
+from concurrent.futures import Future
 import hashlib
 from server import PromptServer
 from aiohttp import web
 from folder_paths import models_dir, get_filename_list
-from comfy.model_management import get_torch_device
+from comfy.model_management import get_torch_device, throw_exception_if_processing_interrupted
 
 def get_comfy_dir():
     dirs = __file__.split('\\')
@@ -81,6 +84,10 @@ with open(config, "r") as f:
     config = yaml.safe_load(f)
 models_folder = config["model_folder"]
 
+# results of fixed-seed runs, keyed on everything that determines them, off unless a size in MB is configured
+result_cache_max_mb = config.get('result_cache_max_mb', 0)
+result_cache_folder = config.get('result_cache_folder') or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'result_cache')
+
 # init and sample_diffusion lib load
 
 
@@ -93,11 +100,14 @@ libs = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 #sys.path.append(os.path.join(comfy_dir, libs ))
 
 from libs.util.util import load_audio, crop_audio
-from libs.dance_diffusion.api import RequestHandler, Request, ModelType
+from libs.dance_diffusion.api import RequestHandler, Request, Response, ModelType, InferenceQueue
+from libs.util.cache import ResultCache, hash_file, hash_tensor, hash_key
 from libs.diffusion_library.sampler import SamplerType
 from libs.diffusion_library.scheduler import SchedulerType
 from libs.dance_diffusion.dd.model import DDModelWrapper
 from libs.dance_diffusion.dd.inference import DDInference
+from libs.dance_diffusion.base.type import PrecisionType, AttentionType
+from libs.dance_diffusion.base.offload import BlockwiseOffloader
 
 from scipy.fft import fft
 from pydub import AudioSegment
@@ -201,6 +211,116 @@ class AudioFFTData:
 
 
 
+def get_request_handler(wrapper, inference, num_workers=1):
+    # one long-lived handler per loaded DD_MODEL, so queued runs reuse the
+    # already loaded weights instead of reading the checkpoint again
+    request_handler = getattr(inference, 'request_handler', None)
+    if request_handler is None:
+        request_handler = RequestHandler(
+            inference.device_accelerator,
+            inference.device_offload,
+            optimize_memory_use=inference.optimize_memory_use,
+            use_autocast=inference.use_autocast,
+            model_wrapper=wrapper,
+            inference=inference,
+            num_workers=num_workers
+        )
+        inference.request_handler = request_handler
+    return request_handler
+
+def get_inference_queue(wrapper, inference):
+    # requests submitted close together, like the clips of a SequenceVariation,
+    # are merged into shared sampler calls by the queue's worker
+    inference_queue = getattr(inference, 'inference_queue', None)
+    if inference_queue is None:
+        inference_queue = InferenceQueue(get_request_handler(wrapper, inference))
+        inference.inference_queue = inference_queue
+    return inference_queue
+
+def release_loaded_model(loaded_model):
+    # a replaced DD_MODEL's queue worker and shard workers would keep its weights alive
+    wrapper, inference = loaded_model
+    inference_queue = getattr(inference, 'inference_queue', None)
+    if inference_queue is not None:
+        inference_queue.shutdown()
+        inference.inference_queue = None
+    request_handler = getattr(inference, 'request_handler', None)
+    if request_handler is not None:
+        request_handler.close_shard_pool()
+
+class SamplingProgress():
+    """
+        Sampler callback that reports the current step of a node to the UI through
+        the "progress" event, at most once every `interval` seconds, optionally
+        together with a low-rate WAV preview of the current denoised estimate. Every
+        step checks for an interrupt from the UI, so a bad preview can be cancelled.
+        The request's own `progress` and `progress_max` take precedence over the
+        step index, which restarts with every sampler call.
+    """
+    def __init__(self, node_id, total_steps, sample_rate, interval=0.5, preview=False, preview_rate=8000):
+        self.node_id = node_id
+        self.total_steps = total_steps
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.preview = preview
+        self.preview_rate = preview_rate
+        self.last_sent = 0.0
+    
+    def encode_preview(self, audio):
+        audio = torchaudio.functional.resample(audio.float().cpu(), self.sample_rate, self.preview_rate).clamp(-1, 1)
+        buffer = BytesIO()
+        sf.write(buffer, audio.T.numpy(), self.preview_rate, format='WAV', subtype='PCM_16')
+        return base64.b64encode(buffer.getvalue()).decode('ascii')
+    
+    def __call__(self, info):
+        throw_exception_if_processing_interrupted()
+        
+        total_steps = info.get('progress_max', self.total_steps)
+        step = min(info.get('progress', info['i'] + 1), total_steps)
+        now = time.monotonic()
+        if now - self.last_sent < self.interval and step < total_steps:
+            return
+        self.last_sent = now
+        
+        server = PromptServer.instance
+        server.send_sync("progress", {"value": step, "max": total_steps, "node": self.node_id}, server.client_id)
+        
+        # V samplers report their estimate as 'pred', K samplers as 'denoised'
+        denoised = info.get('denoised', info.get('pred'))
+        if self.preview and denoised is not None:
+            server.send_sync("jags.audio_preview", {
+                "node": self.node_id,
+                "step": step,
+                "max": total_steps,
+                "audio": self.encode_preview(denoised[0]),
+            }, server.client_id)
+
+result_cache = ResultCache(result_cache_folder, result_cache_max_mb * 1024 * 1024) if result_cache_max_mb > 0 else None
+
+def get_result_key(request, wrapper):
+    # the model file's own hash instead of its path, so renamed or moved models still hit
+    kwargs = request.kwargs
+    audio_source = kwargs.get('audio_source')
+    return hash_key(
+        hash_file(request.model_path),
+        wrapper.get_cache_key()[1:],
+        wrapper.use_compile,
+        request.request_type,
+        kwargs['seed'],
+        kwargs['batch_size'],
+        kwargs['steps'],
+        kwargs['sampler_type'].value,
+        kwargs['scheduler_type'].value,
+        sorted(kwargs['scheduler_args'].items()),
+        kwargs['noise_level'],
+        kwargs['length'],
+        kwargs['overlap'],
+        kwargs['resamples'],
+        sorted(kwargs['early_stopping_args'].items()),
+        sorted(kwargs['feature_cache_args'].items()),
+        hash_tensor(audio_source) if audio_source is not None else None,
+    )
+
 # ****************************************************************************
 class AudioInference():
     def __init__(self):
@@ -214,7 +334,7 @@ class AudioInference():
         return {
             "required": {
                 "audio_model": ("DD_MODEL", ),
-                "mode": (['Generation', 'Variation'],),
+                "mode": (['Generation', 'Variation', 'LongGeneration', 'Extension'],),
                 "batch_size": ("INT", {"default": 1, "min": 1, "max": 10000000000, "step": 1}),
                 "steps": ("INT", {"default": 50, "min": 1, "max": 10000000000, "step": 1}),
                 "sampler": (SamplerType._member_names_, {"default": "V_IPLMS"}),
@@ -228,6 +348,18 @@ class AudioInference():
             "optional": {
                 "input_audio": ("AUDIO", {}),
                 "input_audio_path": ("STRING", {"default": '', "forceInput": True}),
+                "duration": ("FLOAT", {"default": 60.0, "min": 0.1, "max": 3600.0, "step": 0.1}),
+                "overlap": ("INT", {"default": 16384, "min": 0, "max": 10000000000, "step": 1024}),
+                "progress_interval": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 60.0, "step": 0.1}),
+                "preview": (['Disabled', 'Enabled'], {"default": 'Disabled'}),
+                "early_stop_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.0001}),
+                "early_stop_patience": ("INT", {"default": 3, "min": 1, "max": 100, "step": 1}),
+                "resamples": ("INT", {"default": 1, "min": 1, "max": 100, "step": 1}),
+                "feature_cache_levels": ("INT", {"default": 0, "min": 0, "max": 13, "step": 1}),
+                "feature_cache_interval": ("INT", {"default": 3, "min": 1, "max": 100, "step": 1}),
+                },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
                 },
             }
 
@@ -237,15 +369,29 @@ class AudioInference():
 
     CATEGORY = "🎙️Jags_Audio/AudioInference"
 
-    def do_sample(self, audio_model, mode, batch_size, steps, sampler, sigma_min, sigma_max, rho, scheduler, input_audio_path='', input_audio=None, noise_level=0.7, seed=-1):
+    def do_sample(self, audio_model, **kwargs):
+        wrapper, inference = audio_model
+        
+        future, seed = self.submit(audio_model, **kwargs)
+        response = future.result()
+        
+        if response.steps_skipped > 0:
+            print(f"Early stopping skipped {response.steps_skipped} model evaluations.")
+        paths = save_audio(response.result, f"{comfy_dir}/temp", wrapper.sample_rate, f"{seed}_{random.randint(0, 100000)}")
+        return (paths, response.result, wrapper.sample_rate)
+
+    def submit(self, audio_model, mode, batch_size, steps, sampler, sigma_min, sigma_max, rho, scheduler, input_audio_path='', input_audio=None, noise_level=0.7, seed=-1, duration=60.0, overlap=16384, progress_interval=0.5, preview='Disabled', early_stop_threshold=0.0, early_stop_patience=3, resamples=1, feature_cache_levels=0, feature_cache_interval=3, unique_id=None, input_tensor=None):
 
 
         wrapper, inference = audio_model
         device_type_accelerator = get_torch_device()
         device_accelerator = torch.device(device_type_accelerator)
-        device_offload = get_torch_device()
 
-        crop = lambda audio: crop_audio(audio, wrapper.chunk_size, 0)
+        if input_tensor is None:
+            input_tensor = input_audio
+
+        # variations keep shorter inputs at their length, the model pads them to the nearest length it accepts
+        crop = lambda audio: crop_audio(audio, min(audio.shape[1], wrapper.chunk_size) if mode == 'Variation' else wrapper.chunk_size, 0)
 
         if input_tensor is None:
             input_audio_path = None if input_audio_path == '' else input_audio_path
@@ -263,8 +409,8 @@ class AudioInference():
             audio_source = crop(input_tensor)
 
         
-        request_handler = RequestHandler(device_accelerator, device_offload, optimize_memory_use=False, use_autocast=True)
-        
+        # only fixed seeds reproduce their result
+        use_result_cache = result_cache is not None and seed != -1
         seed = seed if(seed!=-1) else torch.randint(0, 4294967294, [1], device=device_type_accelerator).item()
         print(f"Using accelerator: {device_type_accelerator}, Seed: {seed}.")
         
@@ -287,14 +433,32 @@ class AudioInference():
             
             noise_level=noise_level,
             interpolation_positions=None,
-            resamples=None,
+            resamples=resamples,
             keep_start=True,
+            
+            # Extension inpaints without gradients, so it works with every sampler
+            inpainting_args={'method': 'repaint'},
+            
+            length=int(duration * wrapper.sample_rate),
+            overlap=min(overlap, wrapper.chunk_size // 2),
                     
             steps=steps,
             
             sampler_type=SamplerType[sampler],
             sampler_args={'use_tqdm': True},
             
+            # a threshold of 0 keeps every item running for the full step list
+            early_stopping_args={
+                'threshold': early_stop_threshold,
+                'patience': early_stop_patience,
+            },
+            
+            # reuse the deepest levels' features for all but every interval-th model call, 0 levels to disable
+            feature_cache_args={
+                'levels': feature_cache_levels,
+                'interval': feature_cache_interval,
+            },
+            
             scheduler_type=SchedulerType[scheduler],
             scheduler_args={
                 'sigma_min': sigma_min,
@@ -303,9 +467,23 @@ class AudioInference():
             }
         )
         
-        response = request_handler.process_request(request)#, lambda **kwargs: print(f"{kwargs['step'] / kwargs['x']}"))
-        paths = save_audio(response.result, f"{comfy_dir}/temp", wrapper.sample_rate, f"{seed}_{random.randint(0, 100000)}")
-        return (paths, response.result, wrapper.sample_rate)
+        if use_result_cache:
+            result_key = get_result_key(request, wrapper)
+            result = result_cache.get(result_key)
+            
+            if result is not None:
+                print(f"Result cache hit ({result_cache.hits} hits, {result_cache.misses} misses).")
+                future = Future()
+                future.set_result(Response(result.to(device_accelerator)))
+                return future, seed
+        
+        callback = SamplingProgress(unique_id, steps, wrapper.sample_rate, progress_interval, preview == 'Enabled')
+        future = get_inference_queue(wrapper, inference).submit(request, callback)
+        
+        if use_result_cache:
+            future.add_done_callback(lambda future: result_cache.put(result_key, future.result().result) if future.exception() is None else None)
+        
+        return future, seed
 
 class SaveAudio():
     def __init__(self):
@@ -426,10 +604,18 @@ class LoadAudioModelDD():
                 "model": (models, {}),
                 "chunk_size": ("INT", {"default": 65536, "min": 32768, "max": 10000000000, "step": 32768}),
                 "sample_rate": ("INT", {"default": 44100, "min": 1, "max": 10000000000, "step": 1}),
-                "optimize_memory_use": (['Enabled', 'Disabled'], {"default": 'Enabled'}),
+                "optimize_memory_use": (['Enabled', 'Disabled', 'Blockwise'], {"default": 'Enabled'}),
                 "autocast": (['Enabled', 'Disabled'], {"default": 'Enabled'}),
                 },
             "optional": {
+                "memory_budget_mb": ("INT", {"default": 0, "min": 0, "max": 10000000000, "step": 256}),
+                "offload_budget_mb": ("INT", {"default": 0, "min": 0, "max": 10000000000, "step": 64}),
+                "compile": (['Disabled', 'Enabled'], {"default": 'Disabled'}),
+                "precision": ([p.value for p in PrecisionType], {"default": PrecisionType.FP32.value}),
+                "cpu_workers": ("INT", {"default": 1, "min": 1, "max": 256, "step": 1}),
+                "attention": ([a.value for a in AttentionType], {"default": AttentionType.MATH.value}),
+                "attention_window": ("INT", {"default": 512, "min": 64, "max": 65536, "step": 64}),
+                "attention_global_tokens": ("INT", {"default": 0, "min": 0, "max": 1024, "step": 1}),
                 },
             }
 
@@ -440,16 +626,33 @@ class LoadAudioModelDD():
 
     CATEGORY = "🎙️Jags_Audio/Audiotools"
 
-    def DoLoadAudioModelDD(self, model, chunk_size, sample_rate, optimize_memory_use, autocast):
+    def DoLoadAudioModelDD(self, model, chunk_size, sample_rate, optimize_memory_use, autocast, memory_budget_mb=0, offload_budget_mb=0, compile='Disabled', precision='fp32', cpu_workers=1, attention='math', attention_window=512, attention_global_tokens=0):
         global models_folder
         model = os.path.join(models_folder, model)
         device = get_torch_device()
+        if getattr(self, 'loaded_model', None) is not None:
+            release_loaded_model(self.loaded_model)
+            self.loaded_model = None
+        blockwise = optimize_memory_use == 'Blockwise'
+        optimize_memory_use = optimize_memory_use == 'Enabled'
+        autocast = autocast == 'Enabled'
+        if blockwise and compile == 'Enabled':
+            print("Blockwise offloading swaps weights during the forward pass, compile is disabled.")
+            compile = 'Disabled'
         wrapper = DDModelWrapper()
-        wrapper.load(model, device, optimize_memory_use, chunk_size, sample_rate)
-        inference = DDInference(device, device, optimize_memory_use, autocast, wrapper)
+        wrapper.load(model, device, optimize_memory_use or blockwise, chunk_size, sample_rate, use_compile=compile == 'Enabled', precision=PrecisionType(precision), attention=AttentionType(attention), attention_window=attention_window, attention_global_tokens=attention_global_tokens)
+        # only the executing UNet level and the next one are on the accelerator, 0 leaves the resident weights uncapped
+        offload_budget = offload_budget_mb * 1024 * 1024 if offload_budget_mb > 0 else None
+        offloader = BlockwiseOffloader(wrapper.module.diffusion_ema, wrapper.get_offload_units(), device, memory_budget=offload_budget) if blockwise else None
+        # 0 leaves the batch whole and only backs off after an allocation failure
+        memory_budget = memory_budget_mb * 1024 * 1024 if memory_budget_mb > 0 else None
+        inference = DDInference(device, torch.device('cpu'), optimize_memory_use, autocast, wrapper, memory_budget, config.get('inversion_cache_folder'), offloader, config.get('inversion_cache_max_mb', 1024) * 1024 * 1024)
+        inference.warmup()
+        get_request_handler(wrapper, inference, num_workers=cpu_workers)
 
 
         loaded_model = (wrapper, inference)
+        self.loaded_model = loaded_model
 
         return (loaded_model, )
 
@@ -190,6 +190,9 @@ class SequenceVariation:
                 "audio_list": ("AUDIO_LIST",)
             },
             "optional": {},
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
     RETURN_TYPES = ("AUDIO_LIST", "INT")
@@ -198,12 +201,13 @@ class SequenceVariation:
 
     CATEGORY = "🎙️Jags_Audio/VariationUtils"
 
-    def do_variation(self, audio_model, batch_size, steps, sampler, sigma_min, sigma_max, rho, scheduler, audio_list, noise_level=0.7, seed=-1):
+    def do_variation(self, audio_model, batch_size, steps, sampler, sigma_min, sigma_max, rho, scheduler, audio_list, noise_level=0.7, seed=-1, unique_id=None):
         audio_inference = AudioInference()
-        tensor_list_out = []
-        sample_rate = 44100
+        wrapper, _ = audio_model
+        # submit every clip before waiting so the inference queue can batch them together
+        futures = []
         for tensor in audio_list:
-            _, tensor_out, sample_rate = audio_inference.do_sample(
+            future, _ = audio_inference.submit(
                 audio_model=audio_model,
                 mode='Variation',
                 batch_size=batch_size,
@@ -215,9 +219,11 @@ class SequenceVariation:
                 scheduler=scheduler,
                 input_tensor=tensor,
                 noise_level=noise_level,
-                seed=seed)
-            tensor_list_out.append(tensor_out)
-        return tensor_list_out, sample_rate
+                seed=seed,
+                unique_id=unique_id)
+            futures.append(future)
+        tensor_list_out = [future.result().result for future in futures]
+        return tensor_list_out, wrapper.sample_rate
 
 class GetSingle:
     @classmethod
@@ -270,6 +276,9 @@ class BulkVariation:
                 "audio_list": ("AUDIO_LIST",)
             },
             "optional": {},
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
     RETURN_TYPES = ("AUDIO_LIST", "INT")
@@ -278,12 +287,13 @@ class BulkVariation:
 
     CATEGORY = "🎙️Jags_Audio/VariationUtils"
 
-    def do_variation(self, audio_model, batch_size, steps, sampler, sigma_min, sigma_max, rho, scheduler, audio_list, noise_level=0.7, seed=-1):
+    def do_variation(self, audio_model, batch_size, steps, sampler, sigma_min, sigma_max, rho, scheduler, audio_list, noise_level=0.7, seed=-1, unique_id=None):
         audio_inference = AudioInference()
-        tensor_list_out = []
-        sample_rate = 44100
+        wrapper, _ = audio_model
+        # submit every clip before waiting so the inference queue can batch them together
+        futures = []
         for tensor in audio_list:
-            _, tensor_out, sample_rate = audio_inference.do_sample(
+            future, _ = audio_inference.submit(
                 audio_model=audio_model,
                 mode='Variation',
                 batch_size=batch_size,
@@ -295,9 +305,11 @@ class BulkVariation:
                 scheduler=scheduler,
                 input_tensor=tensor,
                 noise_level=noise_level,
-                seed=seed)
-            tensor_list_out.append(tensor_out)
-        return tensor_list_out, sample_rate
+                seed=seed,
+                unique_id=unique_id)
+            futures.append(future)
+        tensor_list_out = [future.result().result for future in futures]
+        return tensor_list_out, wrapper.sample_rate
 
 NODE_CLASS_MAPPINGS = {
     'SliceAudio': SliceAudio,
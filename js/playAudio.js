@@ -62,8 +62,45 @@ function addPlaybackWidget(node, name, url) {
 		slider.name = `(${audio.duration})`;
 		app.canvas.setDirty(true);
 	});
+	return audio;
 }
 
+/*
+Replaces the sampling preview of a node with the latest denoised estimate sent by the server
+*/
+const PREVIEW_WIDGETS = Symbol();
+
+function showSamplingPreview(node, detail) {
+	if (PREVIEW_WIDGETS in node) {
+		node.widgets.length = node[PREVIEW_WIDGETS].count;
+		if (node.widgets_values) {
+			node.widgets_values.length = node.widgets.length;
+		}
+		// stop the previous preview and let go of its media resources before revoking its data
+		const previous = node[PREVIEW_WIDGETS].audio;
+		previous.pause();
+		previous.removeAttribute("src");
+		previous.load();
+		URL.revokeObjectURL(node[PREVIEW_WIDGETS].url);
+	} else {
+		node[PREVIEW_WIDGETS] = { count: node.widgets?.length || 0 };
+	}
+
+	const bytes = Uint8Array.from(atob(detail.audio), (c) => c.charCodeAt(0));
+	const url = URL.createObjectURL(new Blob([bytes], { type: "audio/wav" }));
+	node[PREVIEW_WIDGETS].url = url;
+
+	node[PREVIEW_WIDGETS].audio = addPlaybackWidget(node, `preview ${detail.step}/${detail.max}`, url);
+	app.canvas.setDirty(true);
+}
+
+api.addEventListener("jags.audio_preview", ({ detail }) => {
+	const node = app.graph.getNodeById(detail.node);
+	if (node) {
+		showSamplingPreview(node, detail);
+	}
+});
+
 
 app.registerExtension({
 	name: "Jags.PlayAudio",
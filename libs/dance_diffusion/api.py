@@ -1,6 +1,13 @@
 import torch
 import enum
+import time
+import queue
+import weakref
+import threading
 
+import torch.multiprocessing as mp
+
+from concurrent.futures import Future
 from dataclasses import dataclass
 from typing import Callable
 
@@ -13,6 +20,7 @@ from .dd.inference import DDInference
     
 class RequestType(str, enum.Enum):
     Generation = 'Generation'
+    LongGeneration = 'LongGeneration'
     Variation = 'Variation'
     Interpolation = 'Interpolation'
     Inpainting = 'Inpainting'
@@ -39,9 +47,13 @@ class Request:
 class Response:
     def __init__(
         self,
-        result: torch.Tensor
+        result: torch.Tensor,
+        steps_skipped: int = 0,
+        item_steps_skipped: list[int] = None
     ):
         self.result = result
+        self.steps_skipped = steps_skipped
+        self.item_steps_skipped = item_steps_skipped
 
 
 class RequestHandler:
@@ -50,24 +62,41 @@ class RequestHandler:
         device_accelerator: torch.device, 
         device_offload: torch.device = None, 
         optimize_memory_use: bool = False,
-        use_autocast: bool = True
+        use_autocast: bool = True,
+        model_wrapper: ModelWrapperBase = None,
+        inference: InferenceBase = None,
+        num_workers: int = 1,
+        threads_per_worker: int = None
     ):
         self.device_accelerator = device_accelerator
         self.device_offload = device_offload
         
-        self.model_wrapper: ModelWrapperBase = None
-        self.inference: InferenceBase = None 
+        self.model_wrapper: ModelWrapperBase = model_wrapper
+        self.inference: InferenceBase = inference
         
         self.optimize_memory_use = optimize_memory_use
         self.use_autocast = use_autocast
         
+        # CPU only, batches of the sharded request types are split across worker processes
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker if threads_per_worker else max(1, torch.get_num_threads() // num_workers)
+        self.shard_pool = None
+        self.shard_pool_model = None
+        
     def process_request(
         self,
         request: Request,
         callback: Callable = None
     ) -> Response:
+        model_wrapper = request.kwargs.get('model_wrapper')
+        model_inference = request.kwargs.get('model_inference')
+        
+        # prefer a model the caller already loaded over reading the checkpoint again
+        if (model_wrapper != None and model_inference != None):
+            if (model_wrapper is not self.model_wrapper or model_inference is not self.inference):
+                self.set_model(model_wrapper, model_inference)
         # load the model from the request if it's not already loaded
-        if (self.model_wrapper == None):
+        elif (self.model_wrapper == None):
             self.load_model(
                 request.model_type, 
                 request.model_path, 
@@ -85,6 +114,7 @@ class RequestHandler:
         
         handlers_by_request_type = {
             RequestType.Generation: self.handle_generation,
+            RequestType.LongGeneration: self.handle_long_generation,
             RequestType.Variation: self.handle_variation,
             RequestType.Interpolation: self.handle_interpolation,
             RequestType.Inpainting: self.handle_inpainting,
@@ -94,11 +124,117 @@ class RequestHandler:
         Handler = handlers_by_request_type.get(request.request_type)
         
         if Handler:
+            self.inference.steps_skipped = 0
+            self.inference.item_steps_skipped = []
+            
+            if self.can_shard(request):
+                return self.process_sharded(request)
+            
             tensor_result = Handler(request, callback)
         else:
             raise ValueError('Unexpected RequestType in process_request')
             
-        return Response(tensor_result)
+        return Response(tensor_result, self.inference.steps_skipped, self.inference.item_steps_skipped)
+    
+    def can_shard(self, request: Request) -> bool:
+        return (
+            self.num_workers > 1
+            and self.device_accelerator.type == 'cpu'
+            and request.request_type in sharded_request_types
+            and request.kwargs.get('batch_size', 1) > 1
+        )
+    
+    def get_shard_pool(self):
+        if self.shard_pool != None and self.shard_pool_model is self.model_wrapper:
+            return self.shard_pool
+        
+        self.close_shard_pool()
+        
+        # workers map the same weights instead of holding a copy each
+        self.model_wrapper.module.share_memory()
+        
+        # the workers sample concurrently, so each gets its share of the budget
+        memory_budget = self.inference.memory_budget
+        
+        inference_args = dict(
+            device_accelerator=self.device_accelerator,
+            use_autocast=self.inference.use_autocast,
+            memory_budget=memory_budget // self.num_workers if memory_budget != None else None
+        )
+        
+        self.shard_pool = mp.get_context('spawn').Pool(
+            self.num_workers,
+            initializer=_init_shard_worker,
+            initargs=(self.model_wrapper, type(self.inference), inference_args, self.threads_per_worker)
+        )
+        self.shard_pool_model = self.model_wrapper
+        # a handler dropped without closing its pool would leave the workers and their weights behind
+        self.shard_pool_finalizer = weakref.finalize(self, self.shard_pool.terminate)
+        
+        return self.shard_pool
+    
+    def close_shard_pool(self):
+        if self.shard_pool != None:
+            self.shard_pool_finalizer.detach()
+            self.shard_pool.close()
+            self.shard_pool.join()
+            self.shard_pool = None
+            self.shard_pool_model = None
+    
+    def process_sharded(self, request: Request) -> Response:
+        """
+            Splits the batch of `request` into contiguous shards, one per worker, each
+            with the seeds of its own items, so the concatenated result is identical to
+            running the whole batch in this process. The callback is not forwarded.
+        """
+        kwargs = {key: value for key, value in request.kwargs.items() if key not in ['model_wrapper', 'model_inference']}
+        batch_size = kwargs['batch_size']
+        sample_seeds = InferenceBase.get_sample_seeds(kwargs['seed'], batch_size, kwargs.get('sample_seeds'))
+        
+        # variation sources are expanded to one clip per item, so shards can cut anywhere
+        if request.request_type == RequestType.Variation:
+            if kwargs.get('expansion_map') == None:
+                audio_source = kwargs['audio_source'][None].expand(batch_size, -1, -1)
+            else:
+                audio_source = torch.cat([source[None].expand(count, -1, -1) for source, count in zip(kwargs['audio_source'], kwargs['expansion_map'])])
+        
+        n_shards = min(self.num_workers, batch_size)
+        bounds = [batch_size * shard // n_shards for shard in range(n_shards + 1)]
+        
+        shards = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            shard_kwargs = kwargs.copy()
+            shard_kwargs.update(
+                batch_size = end - start,
+                sample_seeds = sample_seeds[start:end]
+            )
+            
+            if request.request_type == RequestType.Variation:
+                shard_kwargs.update(
+                    audio_source = audio_source[start:end].contiguous(),
+                    expansion_map = [1] * (end - start)
+                )
+            
+            shards.append(Request(
+                request.request_type,
+                request.model_path,
+                request.model_type,
+                request.model_chunk_size,
+                request.model_sample_rate,
+                **shard_kwargs
+            ))
+        
+        results = self.get_shard_pool().map(_run_shard, shards)
+        
+        return Response(
+            torch.cat([result for result, _, _ in results], dim=0),
+            sum(steps_skipped for _, steps_skipped, _ in results),
+            [steps for _, _, item_steps_skipped in results for steps in item_steps_skipped]
+        )
+
+    def set_model(self, model_wrapper: ModelWrapperBase, inference: InferenceBase):
+        self.model_wrapper = model_wrapper
+        self.inference = inference
 
     def load_model(self, model_type, model_path, chunk_size, sample_rate):
         wrappers_by_model_type = {
@@ -139,12 +275,28 @@ class RequestHandler:
         else:
             raise ValueError("Unexpected ModelType in handle_generation")
 
+    def handle_long_generation(self, request: Request, callback: Callable) -> torch.Tensor:
+        kwargs = request.kwargs.copy()
+        
+        if request.model_type in [ModelType.DD]:
+            return self.inference.generate_long(
+                callback=callback,
+                scheduler=kwargs['scheduler_type'],
+                sampler=kwargs['sampler_type'],
+                **kwargs
+            )
+        else:
+            raise ValueError("Unexpected ModelType in handle_long_generation")
+
     def handle_variation(self, request: Request, callback: Callable) -> torch.Tensor:
         kwargs = request.kwargs.copy()
-        kwargs.update(
-            expansion_map = [kwargs['batch_size']],
-            audio_source = kwargs['audio_source'][None,:,:]
-        )
+        
+        # merged requests already carry one source per request and their batch sizes
+        if kwargs.get('expansion_map') == None:
+            kwargs.update(
+                expansion_map = [kwargs['batch_size']],
+                audio_source = kwargs['audio_source'][None,:,:]
+            )
         
         if request.model_type in [ModelType.DD]:
             return self.inference.generate_variation(
@@ -181,7 +333,7 @@ class RequestHandler:
             audio_source = kwargs['audio_source'][None,:,:]
         )
         
-        if request.model_type == [ModelType.DD]:
+        if request.model_type in [ModelType.DD]:
             return self.inference.generate_inpainting(
                 callback=callback,
                 scheduler=kwargs['scheduler_type'],
@@ -206,4 +358,330 @@ class RequestHandler:
                 **kwargs
             )
         else:
-            raise ValueError("Unexpected ModelType in handle_extension")
\ No newline at end of file
+            raise ValueError("Unexpected ModelType in handle_extension")
+
+
+sharded_request_types = [RequestType.Generation, RequestType.LongGeneration, RequestType.Variation]
+
+# the handler of a shard worker process, set up once by the pool initializer
+_shard_handler: RequestHandler = None
+
+def _init_shard_worker(model_wrapper, Inference, inference_args, num_threads):
+    global _shard_handler
+    
+    torch.set_num_threads(num_threads)
+    
+    inference = Inference(model=model_wrapper, **inference_args)
+    _shard_handler = RequestHandler(
+        inference_args['device_accelerator'],
+        use_autocast=inference_args['use_autocast'],
+        model_wrapper=model_wrapper,
+        inference=inference
+    )
+
+def _run_shard(request: Request) -> tuple:
+    response = _shard_handler.process_request(request)
+    return response.result, response.steps_skipped, response.item_steps_skipped
+
+
+@dataclass
+class InferenceJob:
+    request: Request
+    callback: Callable
+    future: Future
+
+
+class InferenceQueue:
+    """
+        Runs Requests on a background worker thread through one RequestHandler.
+        
+        Requests submitted within `batch_window` seconds of each other are merged
+        into one batched sampler call when they only differ in their seeds, batch
+        sizes and (for Variation) source clips, up to `max_batch_size` items. Each
+        submitted Request gets its own Future resolving to its slice of the result.
+        A request that cannot be merged or run only fails its own Future, merged
+        requests are rerun one by one after a failure.
+    """
+    mergeable_request_types = [RequestType.Generation, RequestType.Variation]
+    
+    def __init__(
+        self,
+        request_handler: RequestHandler,
+        batch_window: float = 0.05,
+        max_batch_size: int = 16
+    ):
+        self.request_handler = request_handler
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        
+        self.batches_run = 0
+        self.requests_run = 0
+        self.batch_fill = 0.0
+        
+        # the worker only holds the queue weakly, dropping the last reference stops it
+        self.stop = weakref.finalize(self, self.jobs.put, None)
+        self.worker = threading.Thread(target=InferenceQueue.run, args=(weakref.ref(self), self.jobs), name='dd-inference-queue', daemon=True)
+        self.worker.start()
+    
+    def submit(
+        self,
+        request: Request,
+        callback: Callable = None
+    ) -> Future:
+        future = Future()
+        self.jobs.put(InferenceJob(request, callback, future))
+        return future
+    
+    def shutdown(self):
+        self.stop()
+        self.worker.join()
+    
+    def get_metrics(self) -> dict:
+        with self.lock:
+            return {
+                'queue_depth': self.jobs.qsize(),
+                'batches_run': self.batches_run,
+                'requests_run': self.requests_run,
+                'requests_per_batch': self.requests_run / self.batches_run if self.batches_run > 0 else 0.0,
+                'batch_fill': self.batch_fill / self.batches_run if self.batches_run > 0 else 0.0,
+            }
+    
+    def get_merge_key(self, request: Request) -> tuple:
+        """
+            Requests with equal keys can share sampler calls, None means the request
+            always runs on its own.
+        """
+        kwargs = request.kwargs
+        sampler_args = kwargs.get('sampler_args') or {}
+        
+        if request.request_type not in self.mergeable_request_types:
+            return None
+        if any(not isinstance(value, (bool, int, float, str)) for value in sampler_args.values()):
+            return None
+        
+        audio_source = kwargs.get('audio_source')
+        
+        return (
+            request.request_type,
+            request.model_type,
+            request.model_path,
+            request.model_chunk_size,
+            request.model_sample_rate,
+            id(kwargs.get('model_wrapper')),
+            kwargs.get('sampler_type'),
+            kwargs.get('scheduler_type'),
+            kwargs.get('steps'),
+            tuple(sorted((kwargs.get('scheduler_args') or {}).items())),
+            tuple(sorted(sampler_args.items())),
+            tuple(sorted((kwargs.get('early_stopping_args') or {}).items())),
+            tuple(sorted((kwargs.get('feature_cache_args') or {}).items())),
+            kwargs.get('noise_level') if request.request_type == RequestType.Variation else None,
+            tuple(audio_source.shape) if request.request_type == RequestType.Variation else None,
+        )
+    
+    def merge_requests(self, requests: list[Request]) -> Request:
+        first = requests[0]
+        batch_sizes = [request.kwargs['batch_size'] for request in requests]
+        
+        kwargs = first.kwargs.copy()
+        kwargs.update(
+            batch_size = sum(batch_sizes),
+            sample_seeds = [
+                sample_seed
+                for request in requests
+                for sample_seed in InferenceBase.get_sample_seeds(request.kwargs['seed'], request.kwargs['batch_size'], request.kwargs.get('sample_seeds'))
+            ],
+            scheduler_args = dict(first.kwargs['scheduler_args']),
+            sampler_args = dict(first.kwargs['sampler_args']),
+        )
+        
+        if first.request_type == RequestType.Variation:
+            kwargs.update(
+                audio_source = torch.stack([request.kwargs['audio_source'] for request in requests]),
+                expansion_map = batch_sizes
+            )
+        
+        return Request(
+            first.request_type,
+            first.model_path,
+            first.model_type,
+            first.model_chunk_size,
+            first.model_sample_rate,
+            **kwargs
+        )
+    
+    def group_jobs(self, jobs: list[InferenceJob]) -> list[list[InferenceJob]]:
+        groups = []
+        open_groups = {}
+        
+        for job in jobs:
+            try:
+                key = self.get_merge_key(job.request)
+                batch_size = job.request.kwargs['batch_size']
+            except Exception as error:
+                # a malformed request fails on its own instead of taking the worker down
+                self.fail_jobs([job], error)
+                continue
+            
+            group = open_groups.get(key) if key != None else None
+            
+            if group == None or sum(j.request.kwargs['batch_size'] for j in group) + batch_size > self.max_batch_size:
+                group = []
+                groups.append(group)
+                if key != None:
+                    open_groups[key] = group
+            
+            group.append(job)
+        
+        return groups
+    
+    @staticmethod
+    def fail_jobs(jobs: list[InferenceJob], error: Exception):
+        for job in jobs:
+            if not job.future.done():
+                job.future.set_exception(error)
+    
+    @staticmethod
+    def slice_callback(
+        callback: Callable,
+        start: int,
+        end: int
+    ) -> Callable:
+        """
+            Passes a merged batch's sampler info on to the job owning items `start`
+            to `end`, with the batched tensors cut down to the job's own items. Sampler
+            calls that do not cover any of them only report progress.
+        """
+        def sliced_callback(info):
+            batch_start = info.get('batch_start', 0)
+            sliced = dict(info)
+            
+            for name in ['x', 'denoised', 'pred']:
+                tensor = info.get(name)
+                if tensor is None:
+                    continue
+                
+                tensor = tensor[max(start - batch_start, 0):max(end - batch_start, 0)]
+                if tensor.shape[0] == 0:
+                    del sliced[name]
+                else:
+                    sliced[name] = tensor
+            
+            callback(sliced)
+        
+        return sliced_callback
+    
+    def run_group(self, jobs: list[InferenceJob]):
+        jobs = [job for job in jobs if job.future.set_running_or_notify_cancel()]
+        
+        if len(jobs) == 0:
+            return
+        
+        if len(jobs) == 1:
+            self.run_job(jobs[0])
+            return
+        
+        try:
+            request = self.merge_requests([job.request for job in jobs])
+        except Exception:
+            # whichever request cannot be merged then fails alone
+            for job in jobs:
+                self.run_job(job)
+            return
+        
+        callbacks = []
+        start = 0
+        for job in jobs:
+            if job.callback != None:
+                callbacks.append(self.slice_callback(job.callback, start, start + job.request.kwargs['batch_size']))
+            start += job.request.kwargs['batch_size']
+        callback = lambda info: [job_callback(info) for job_callback in callbacks]
+        
+        try:
+            response = self.request_handler.process_request(request, callback)
+        except Exception:
+            # the merged call cannot tell whose request broke it, rerun each alone
+            for job in jobs:
+                self.run_job(job)
+            return
+        
+        batch_size = request.kwargs['batch_size']
+        
+        with self.lock:
+            self.batches_run += 1
+            self.requests_run += len(jobs)
+            self.batch_fill += min(1.0, batch_size / self.max_batch_size)
+        
+        batch_sizes = [job.request.kwargs['batch_size'] for job in jobs]
+        
+        try:
+            results = response.result.split(batch_sizes, dim=0)
+        except Exception as error:
+            self.fail_jobs(jobs, error)
+            return
+        
+        item_steps_skipped = response.item_steps_skipped
+        if item_steps_skipped == None or len(item_steps_skipped) != batch_size:
+            item_steps_skipped = [0] * batch_size
+        
+        start = 0
+        for job, result, job_batch_size in zip(jobs, results, batch_sizes):
+            job_steps_skipped = item_steps_skipped[start:start + job_batch_size]
+            job.future.set_result(Response(result, sum(job_steps_skipped), job_steps_skipped))
+            start += job_batch_size
+    
+    def run_job(self, job: InferenceJob):
+        try:
+            response = self.request_handler.process_request(job.request, job.callback)
+        except Exception as error:
+            self.fail_jobs([job], error)
+            return
+        
+        with self.lock:
+            self.batches_run += 1
+            self.requests_run += 1
+            self.batch_fill += min(1.0, job.request.kwargs['batch_size'] / self.max_batch_size)
+        
+        job.future.set_result(response)
+    
+    @staticmethod
+    def run(queue_ref: weakref.ref, pending: queue.Queue):
+        stopping = False
+        
+        while not stopping:
+            job = pending.get()
+            if job == None:
+                break
+            
+            inference_queue = queue_ref()
+            if inference_queue == None:
+                break
+            
+            jobs = [job]
+            deadline = time.monotonic() + inference_queue.batch_window
+            
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if job == None:
+                    stopping = True
+                    break
+                jobs.append(job)
+            
+            group = None
+            for group in inference_queue.group_jobs(jobs):
+                try:
+                    inference_queue.run_group(group)
+                except Exception as error:
+                    # whatever goes wrong, the futures resolve and the worker keeps serving
+                    inference_queue.fail_jobs(group, error)
+            
+            del inference_queue, jobs, job, group
@@ -2,9 +2,46 @@ import torch
 import enum
 import contextlib
 from contextlib import nullcontext
-from typing import Tuple
+from typing import Tuple, Callable
 
 from .model import ModelWrapperBase
+from .type import PrecisionType
+from .offload import BlockwiseOffloader
+
+class StepProgress():
+    """
+        Sampler callback for a whole request, which may run several sampler calls:
+        micro-batches, extension segments or interpolation inversions. Each call
+        gets its own `phase` callback that adds the request-wide `progress` (model
+        evaluations per item done so far), `progress_max` and the `batch_start` of
+        the call's first item to the info before passing it on.
+    """
+    def __init__(self, callback: Callable, total: int):
+        self.callback = callback
+        self.total = max(1, total)
+        self.done = 0
+        self.reported = 0
+    
+    @staticmethod
+    def get_steps(step_list: torch.Tensor) -> int:
+        # samplers call back once per step between consecutive entries, some once more at the end
+        return max(1, len(step_list) - 1)
+    
+    def phase(
+        self,
+        steps: int,
+        start: int = 0,
+        end: int = 1
+    ) -> Callable:
+        done = self.done
+        self.done += steps * (end - start)
+        
+        def callback(info):
+            self.reported = min(max(self.reported, done + min(info['i'] + 1, steps) * (end - start)), self.total)
+            self.callback(dict(info, progress=self.reported, progress_max=self.total, batch_start=start))
+        
+        return callback
+
 
 class InferenceBase():
     def __init__(
@@ -13,15 +50,23 @@ class InferenceBase():
         device_offload: torch.device,
         optimize_memory_use: bool,
         use_autocast: bool,
-        model: ModelWrapperBase
+        model: ModelWrapperBase,
+        memory_budget: int = None,
+        offloader: BlockwiseOffloader = None
     ):
         self.device_accelerator = device_accelerator
         self.device_offload = device_offload if(optimize_memory_use==True) else None
         self.optimize_memory_use = optimize_memory_use
         self.use_autocast = use_autocast
         self.model = model
+        self.memory_budget = memory_budget
+        self.offloader = offloader
         self.generator = torch.Generator(device_accelerator)# if (device_accelerator.type != 'mps') else torch.device('cpu'))
         self.rng_state = None
+        # model evaluations saved by early stopping, summed over batch items, reset per request
+        self.steps_skipped = 0
+        # the same per batch item, in batch order
+        self.item_steps_skipped = []
         
     def set_device_accelerator(
         self,
@@ -58,46 +103,168 @@ class InferenceBase():
         return out
         
     
-    # def cc_randn(self, shape:tuple, seed:int, device:torch.device, dtype = None, rng_state_in:torch.Tensor = None):
+    @staticmethod
+    def get_sample_seeds(
+        seed: int,
+        batch_size: int,
+        sample_seeds: list[int] = None
+    ) -> list[int]:
+        """
+            Returns one seed per batch item, `seed + index` unless explicit
+            `sample_seeds` are given. Noise drawn from these only depends on the
+            item's own seed, so a batch can be split into micro-batches, shards or
+            separate runs and still produce bit-identical results.
+        """
+        if sample_seeds == None:
+            sample_seeds = [seed + index for index in range(batch_size)]
+        
+        assert len(sample_seeds) == batch_size, "sample_seeds must contain one seed per batch item"
+        
+        return list(sample_seeds)
+    
+    def get_generators(
+        self,
+        sample_seeds: list[int]
+    ) -> list[torch.Generator]:
+        return [torch.Generator(self.generator.device).manual_seed(sample_seed) for sample_seed in sample_seeds]
+    
+    def cc_randn(
+        self,
+        shape: tuple,
+        generators: list[torch.Generator],
+        dtype: torch.dtype = None
+    ) -> torch.Tensor:
+        rn = torch.empty(shape, device=self.device_accelerator, dtype=dtype)
         
-    #     initial_rng_state = self.generator.get_state()
-    #     rng_state_out = torch.empty([shape[0], shape[1]], dtype=torch.ByteTensor,device=self.generator.device)
+        for sample, generator in enumerate(generators):
+            rn[sample] = torch.randn(shape[1:], generator=generator, device=self.device_accelerator, dtype=dtype)
         
-    #     rn = torch.empty(shape,device=device, dtype=dtype, device=device)
+        return rn
+    
+    def cc_randn_like(
+        self,
+        input: torch.Tensor,
+        generators: list[torch.Generator]
+    ) -> torch.Tensor:
+        return self.cc_randn(input.shape, generators, input.dtype).to(input.device)
+    
+    def cc_noise_sampler(
+        self,
+        input: torch.Tensor,
+        generators: list[torch.Generator]
+    ):
+        """
+            k-diffusion compatible noise sampler that keeps drawing from the per-sample
+            generators, so ancestral samplers stay deterministic per batch item as well.
+        """
+        return lambda sigma, sigma_next: self.cc_randn_like(input, generators)
+    
+    def with_noise_sampler(
+        self,
+        sampler_args: dict,
+        input: torch.Tensor,
+        generators: list[torch.Generator]
+    ) -> dict:
+        if sampler_args.get('noise_sampler') != None:
+            return sampler_args
         
-    #     for sample in range(shape[0]):
-    #         for channel in range(shape[1]):
-    #             self.generator.manual_seed(seed + sample * shape[1] + channel) if(rng_state_in == None) else self.generator.set_state(rng_state_in[sample, channel])
-    #             rn[sample, channel] = torch.randn([shape[2]], generator=self.generator, dtype=dtype, device=device)
-    #             rng_state_out[sample, channel] = self.generator.get_state()
+        return dict(sampler_args, noise_sampler=self.cc_noise_sampler(input, generators))
         
-    #     self.rng_state = rng_state_out
-    #     self.generator.set_state(initial_rng_state)
-    #     return rn
     
-    # def cc_randn_like(self, input:torch.Tensor, seed:int, rng_state_in:torch.Tensor = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    @staticmethod
+    def track_progress(
+        callback: Callable,
+        total: int
+    ) -> Callable:
+        if callback == None or isinstance(callback, StepProgress):
+            return callback
         
-    #     initial_rng_state = self.generator.get_state()
-    #     rng_state_out = torch.empty([input.shape[0], input.shape[1]], dtype=torch.ByteTensor,device=self.generator.device)
+        return StepProgress(callback, total)
+    
+    @staticmethod
+    def phase_callback(
+        callback: Callable,
+        step_list: torch.Tensor,
+        start: int = 0,
+        end: int = 1
+    ) -> Callable:
+        if not isinstance(callback, StepProgress):
+            return callback
         
-    #     rn = torch.empty_like(input)
+        return callback.phase(StepProgress.get_steps(step_list), start, end)
+    
+    @staticmethod
+    def slice_batch(
+        tensor: torch.Tensor,
+        start: int,
+        end: int,
+        batch_size: int
+    ) -> torch.Tensor:
+        # tensors broadcast over the batch (leading dimension of 1) are shared by every micro-batch
+        return tensor[start:end] if tensor.shape[0] == batch_size else tensor
+    
+    def get_micro_batch_size(
+        self,
+        batch_size: int,
+        bytes_per_sample: int = None
+    ) -> int:
+        if self.memory_budget == None or bytes_per_sample == None:
+            return batch_size
         
-    #     for sample in range(input.shape[0]):
-    #         for channel in range(input.shape[1]):
-    #             self.generator.manual_seed(seed + sample * input.shape[1] + channel) if(rng_state_in == None) else self.generator.set_state(rng_state_in[sample, channel])
-    #             rn[sample, channel] = torch.randn([input.shape[2]], generator=self.generator, dtype=input.dtype, device=input.device)
-    #             rng_state_out[sample, channel] = self.generator.get_state()
+        return max(1, min(batch_size, self.memory_budget // bytes_per_sample))
+    
+    @staticmethod
+    def is_out_of_memory(error: RuntimeError) -> bool:
+        message = str(error)
+        return any(marker in message for marker in ['out of memory', "can't allocate memory", 'Cannot allocate memory'])
+    
+    def sample_batched(
+        self,
+        batch_size: int,
+        sample_fn: Callable[[int, int], torch.Tensor],
+        bytes_per_sample: int = None
+    ) -> torch.Tensor:
+        """
+            Runs `sample_fn(start, end)` over micro-batches of the requested batch and
+            concatenates the results. The micro-batch size starts from the memory
+            budget (or the whole batch) and is halved whenever an allocation fails.
+        """
+        micro_batch_size = self.get_micro_batch_size(batch_size, bytes_per_sample)
+        results = []
         
-    #     self.rng_state = rng_state_out
-    #     self.generator.set_state(initial_rng_state)
-    #     return rn
+        start = 0
+        while start < batch_size:
+            end = min(start + micro_batch_size, batch_size)
+            
+            try:
+                results.append(sample_fn(start, end))
+            except RuntimeError as error:
+                if not self.is_out_of_memory(error) or end - start == 1:
+                    raise
+                
+                micro_batch_size = max(1, (end - start) // 2)
+                print(f"Out of memory with a micro-batch of {end - start}, retrying with {micro_batch_size}.")
+                
+                del error
+                if self.device_accelerator.type == 'cuda':
+                    torch.cuda.empty_cache()
+                continue
+            
+            start = end
         
+        return results[0] if len(results) == 1 else torch.cat(results, dim=0)
     
     def autocast_context(self):
-        if self.device_accelerator.type == 'cuda':
-            return torch.cuda.amp.autocast()
+        precision = self.model.precision if self.model != None else PrecisionType.FP32
+        
+        if precision in [PrecisionType.FP16_STORAGE, PrecisionType.INT8]:
+            # weights are upcast layer by layer or run through int8 kernels, the rest stays in fp32
+            return nullcontext()
+        elif self.device_accelerator.type == 'cuda':
+            return torch.cuda.amp.autocast(dtype=torch.bfloat16 if precision == PrecisionType.BF16 else torch.float16)
         elif self.device_accelerator.type == 'cpu':
-            return torch.cpu.amp.autocast()
+            # CPU autocast only lowers to bf16, which the fp32 policy asks not to do
+            return torch.cpu.amp.autocast(dtype=torch.bfloat16) if precision == PrecisionType.BF16 else nullcontext()
         elif self.device_accelerator.type == 'mps':
             return nullcontext()
         else:
@@ -109,6 +276,9 @@ class InferenceBase():
             Used by inference implementations, this context manager moves the
             passed model to the inference's `device_accelerator` device on enter,
             and then returns it to the `device_offload` device on exit.
+            
+            With a block-wise `offloader` the model's hooks move its weights level by
+            level instead, and everything still resident is evicted on exit.
 
             It also wraps the `inference.autocast_context()` context.
         """
@@ -116,6 +286,13 @@ class InferenceBase():
         autocast = self.autocast_context() if self.use_autocast else nullcontext()
         
         with autocast:
+            if self.offloader != None:
+                try:
+                    yield None
+                finally:
+                    self.offloader.evict_all()
+                return
+            
             if self.optimize_memory_use:
                 model.to(self.device_accelerator)
 
@@ -1,5 +1,7 @@
 import torch
 
+from .type import PrecisionType
+
 class ModelWrapperBase():
     
     def __init__(self):
@@ -11,6 +13,7 @@ class ModelWrapperBase():
         
         self.chunk_size: int = None
         self.sample_rate: int = None
+        self.precision: PrecisionType = PrecisionType.FP32
         
         
     def load(
@@ -21,4 +24,48 @@ class ModelWrapperBase():
         chunk_size: int=131072,
         sample_rate: int=48000
     ):
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+    
+    def get_cache_key(
+        self
+    ) -> tuple:
+        """
+            Identifies everything about the loaded model that changes its outputs,
+            for use in cache keys.
+        """
+        return (self.path, self.chunk_size, self.sample_rate, self.precision.value)
+    
+    def get_offload_units(
+        self
+    ) -> list:
+        """
+            Groups of modules, in execution order, that block-wise offloading moves to
+            the accelerator one at a time.
+        """
+        raise NotImplementedError
+    
+    def get_length_multiple(
+        self
+    ) -> int:
+        """
+            Input lengths the model accepts are multiples of this.
+        """
+        return 1
+    
+    def get_min_length(
+        self
+    ) -> int:
+        """
+            The shortest input length the model accepts.
+        """
+        return self.get_length_multiple()
+    
+    def get_sample_memory(
+        self,
+        length: int
+    ) -> int:
+        """
+            Rough estimate of the peak activation memory in bytes needed to denoise one
+            sample of `length`, used to size micro-batches. None when unknown.
+        """
+        return None
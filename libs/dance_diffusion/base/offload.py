@@ -0,0 +1,139 @@
+import torch
+from torch import nn
+from collections import OrderedDict
+
+
+class BlockwiseOffloader():
+    """
+        Keeps the weights of a model on `device_offload` and only moves the unit
+        (a list of modules, run one after the other) that is currently executing to
+        `device_accelerator`. While a unit runs, the next one is already being
+        copied, from pinned host memory on a side stream when the accelerator is a
+        GPU. A finished unit is evicted right away by pointing its parameters back
+        at their host copies, so no copy ever goes back to the host.
+
+        `memory_budget` caps the resident weight bytes. Prefetching is skipped when it
+        would not fit. Activations are not counted. With CPU for both devices every load still makes a real copy,
+        so the budget and `peak_resident_bytes` can be checked without a GPU.
+    """
+    def __init__(
+        self,
+        model: nn.Module,
+        units: list[list[nn.Module]],
+        device_accelerator: torch.device,
+        device_offload: torch.device = torch.device('cpu'),
+        memory_budget: int = None
+    ):
+        self.units = units
+        self.device_accelerator = device_accelerator
+        self.device_offload = device_offload
+        self.memory_budget = memory_budget
+
+        self.use_streams = device_accelerator.type == 'cuda'
+        self.copy_stream = torch.cuda.Stream(device_accelerator) if self.use_streams else None
+
+        # (tensor, host) of every parameter and buffer in a unit: the tensor whose .data
+        # is swapped between devices, and its copy on the offload device
+        self.unit_tensors = []
+        self.unit_bytes = []
+        unit_tensor_ids = set()
+
+        for unit in units:
+            tensors = []
+            for module in unit:
+                for submodule in module.modules():
+                    for name, tensor in list(submodule._parameters.items()) + list(submodule._buffers.items()):
+                        if tensor is None:
+                            continue
+                        host = tensor.data.to(device_offload)
+                        if self.use_streams:
+                            host = host.pin_memory()
+                        tensor.data = host
+                        tensors.append((tensor, host))
+                        unit_tensor_ids.add(id(tensor))
+            self.unit_tensors.append(tensors)
+            self.unit_bytes.append(sum(host.numel() * host.element_size() for _, host in tensors))
+
+        if memory_budget != None and max(self.unit_bytes) > memory_budget:
+            raise ValueError(f"The largest offload unit needs {max(self.unit_bytes)} bytes, more than the memory budget of {memory_budget}.")
+
+        # everything outside the units (e.g. the timestep embedding) stays on the accelerator
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            if id(tensor) not in unit_tensor_ids:
+                tensor.data = tensor.data.to(device_accelerator)
+
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        self.peak_resident_bytes = 0
+        self.current = None
+
+        self.hooks = []
+        for index, unit in enumerate(units):
+            self.hooks.append(unit[0].register_forward_pre_hook(lambda module, args, index=index: self.enter_unit(index)))
+            self.hooks.append(unit[-1].register_forward_hook(lambda module, args, output, index=index: self.exit_unit(index)))
+
+    def load(self, index: int) -> bool:
+        if index in self.resident:
+            return True
+
+        if self.memory_budget != None and self.resident_bytes + self.unit_bytes[index] > self.memory_budget:
+            return False
+
+        if self.use_streams:
+            with torch.cuda.stream(self.copy_stream):
+                copies = [host.to(self.device_accelerator, non_blocking=True) for _, host in self.unit_tensors[index]]
+                event = torch.cuda.Event()
+                event.record(self.copy_stream)
+        else:
+            copies = [host.to(self.device_accelerator, copy=True) for _, host in self.unit_tensors[index]]
+            event = None
+
+        self.resident[index] = (copies, event)
+        self.resident_bytes += self.unit_bytes[index]
+        self.peak_resident_bytes = max(self.peak_resident_bytes, self.resident_bytes)
+
+        return True
+
+    def evict(self, index: int):
+        if index not in self.resident:
+            return
+
+        del self.resident[index]
+        self.resident_bytes -= self.unit_bytes[index]
+
+        for tensor, host in self.unit_tensors[index]:
+            tensor.data = host
+
+    def evict_all(self):
+        for index in list(self.resident.keys()):
+            self.evict(index)
+        self.current = None
+
+    def enter_unit(self, index: int):
+        # a unit that was not prefetched, e.g. on the first step, has to make room for itself
+        while not self.load(index):
+            self.evict(next(iter(self.resident)))
+
+        copies, event = self.resident[index]
+
+        if self.use_streams:
+            compute_stream = torch.cuda.current_stream(self.device_accelerator)
+            compute_stream.wait_event(event)
+            for copy in copies:
+                copy.record_stream(compute_stream)
+
+        for (tensor, _), copy in zip(self.unit_tensors[index], copies):
+            tensor.data = copy
+
+        self.current = index
+        self.load((index + 1) % len(self.units))
+
+    def exit_unit(self, index: int):
+        self.evict(index)
+        self.current = None
+
+    def remove(self):
+        self.evict_all()
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
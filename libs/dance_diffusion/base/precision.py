@@ -0,0 +1,51 @@
+import torch
+from torch import nn
+
+from .type import PrecisionType
+
+
+def _upcast_parameters(module: nn.Module, args):
+    module._stored_parameters = dict(module._parameters)
+    
+    for name, param in module._stored_parameters.items():
+        if param is not None:
+            module._parameters[name] = param.float()
+
+
+def _restore_parameters(module: nn.Module, args, output):
+    module._parameters.update(module._stored_parameters)
+    module._stored_parameters = None
+
+
+def apply_precision(
+    module: nn.Module,
+    precision: PrecisionType,
+    keep_fp32: tuple = ()
+) -> nn.Module:
+    """
+        Casts the parameters of `module` once to the storage dtype of `precision`.
+        
+        For `FP16_STORAGE`, every layer gets hooks that upcast its own weights to
+        fp32 for the duration of its forward, so only one layer's weights exist in
+        fp32 at a time. Instances of the `keep_fp32` types are left untouched.
+        
+        `INT8` changes the layers themselves and is applied by the model wrapper.
+    """
+    if precision in [PrecisionType.FP32, PrecisionType.INT8]:
+        return module
+    
+    weight_dtype = precision.get_weight_dtype()
+    
+    for submodule in module.modules():
+        if isinstance(submodule, keep_fp32) or len(submodule._parameters) == 0:
+            continue
+        
+        for param in submodule._parameters.values():
+            if param is not None:
+                param.data = param.data.to(weight_dtype)
+        
+        if precision == PrecisionType.FP16_STORAGE:
+            submodule.register_forward_pre_hook(_upcast_parameters)
+            submodule.register_forward_hook(_restore_parameters)
+    
+    return module
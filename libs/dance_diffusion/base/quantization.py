@@ -0,0 +1,61 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+
+class Conv1dAsLinear(nn.Module):
+    """
+        Conv1d (stride 1, no dilation or groups) evaluated as one Linear layer per
+        kernel tap, each applied to the input shifted by that tap, so that dynamic
+        int8 quantization, which only covers Linear layers, applies to it. Unlike
+        im2col patches, no copy kernel_size times the size of the input is made.
+    """
+    def __init__(self, conv: nn.Conv1d):
+        super().__init__()
+        assert conv.stride[0] == 1 and conv.dilation[0] == 1 and conv.groups == 1, "only plain convolutions can be converted"
+
+        self.kernel_size = conv.kernel_size[0]
+        self.padding = conv.padding[0]
+        self.padding_mode = 'constant' if conv.padding_mode == 'zeros' else conv.padding_mode
+
+        # the bias is added once, by the first tap
+        self.taps = nn.ModuleList([
+            nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None and k == 0) for k in range(self.kernel_size)
+        ])
+
+        with torch.no_grad():
+            for k, tap in enumerate(self.taps):
+                tap.weight.copy_(conv.weight[:, :, k])
+            if conv.bias is not None:
+                self.taps[0].bias.copy_(conv.bias)
+
+    def forward(self, input):
+        s = input.shape[2]
+        input = F.pad(input, (self.padding,) * 2, self.padding_mode).transpose(1, 2).contiguous()
+
+        output = self.taps[0](input[:, :s])
+        for k in range(1, self.kernel_size):
+            output += self.taps[k](input[:, k:k + s])
+
+        return output.transpose(1, 2)
+
+
+def quantize_convs(
+    module: nn.Module,
+    convs: list[nn.Conv1d]
+) -> nn.Module:
+    """
+        Replaces the given Conv1d layers of `module` in place by their Linear form and
+        quantizes those dynamically to int8: weights are stored as int8, activations
+        are quantized per call from their observed range. Runs on CPU only. This
+        only saves weight memory: it was slower than the fp32 convolutions on the
+        CPUs measured, see libs/scripts/benchmark_unet.py.
+    """
+    convs = set(convs)
+
+    for parent in list(module.modules()):
+        for name, child in parent.named_children():
+            if child in convs:
+                setattr(parent, name, Conv1dAsLinear(child))
+
+    return torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
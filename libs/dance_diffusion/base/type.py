@@ -1,4 +1,31 @@
 import enum
+import torch
 
 class ModelType(str, enum.Enum):
-    DD = 'DD'
\ No newline at end of file
+    DD = 'DD'
+
+
+class PrecisionType(str, enum.Enum):
+    FP32 = 'fp32'
+    BF16 = 'bf16'
+    FP16_STORAGE = 'fp16_storage'
+    # quarter size weights, but slower than fp32 on the CPUs measured
+    INT8 = 'int8_memory_only'
+    
+    def get_weight_dtype(self) -> torch.dtype:
+        return {
+            PrecisionType.FP32: torch.float32,
+            PrecisionType.INT8: torch.qint8,
+            PrecisionType.BF16: torch.bfloat16,
+            PrecisionType.FP16_STORAGE: torch.float16,
+        }[self]
+    
+    def get_compute_dtype(self) -> torch.dtype:
+        return torch.bfloat16 if self == PrecisionType.BF16 else torch.float32
+
+
+class AttentionType(str, enum.Enum):
+    MATH = 'math'
+    SDPA = 'sdpa'
+    CHUNKED = 'chunked'
+    LOCAL = 'local'
@@ -4,6 +4,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from . import utils
+from libs.dance_diffusion.base.type import AttentionType
 
 class ResidualBlock(nn.Module):
     def __init__(self, main, skip=None):
@@ -75,6 +76,46 @@ class ResConvBlock(ResidualBlock):
             nn.GELU() if not is_last else nn.Identity(),
         ], skip)
 
+    def can_fold(self, input):
+        conv = self.main[0]
+        return isinstance(conv, nn.Conv1d) and conv.padding_mode == 'zeros' and isinstance(self.skip, nn.Conv1d) and input.shape[2] > 2 * conv.padding[0]
+
+    def forward(self, input, planes=None, planes_index=None):
+        """
+            `planes` are [n, c] values of channels that are constant over the whole
+            length and belong at channel `planes_index` of `input`. Instead of being
+            expanded and concatenated, they are folded into the bias of the first
+            convolution and of the skip, with the zero padded edges corrected.
+        """
+        if planes is None:
+            return super().forward(input)
+        
+        if not self.can_fold(input):
+            planes = planes[..., None].expand(-1, -1, input.shape[2])
+            return super().forward(torch.cat([input[:, :planes_index], planes, input[:, planes_index:]], dim=1))
+        
+        conv, skip = self.main[0], self.skip
+        first, last = planes_index, planes_index + planes.shape[1]
+        padding, length = conv.padding[0], input.shape[2]
+        
+        weight = conv.weight.to(input.dtype)
+        bias = conv.bias.to(input.dtype) if conv.bias is not None else None
+        output = F.conv1d(input, torch.cat([weight[:, :first], weight[:, last:]], dim=1), padding=padding)
+        
+        # away from the edges the planes contribute a constant, a window of 2 * padding + 1 holds every distinct value
+        window = planes[..., None].expand(-1, -1, 2 * padding + 1)
+        constant = F.conv1d(window, weight[:, first:last], bias, padding=padding)
+        output[..., :padding] += constant[..., :padding]
+        output[..., padding:length - padding] += constant[..., padding:padding + 1]
+        output[..., length - padding:] += constant[..., padding + 1:]
+        
+        skip_weight = skip.weight.to(input.dtype)
+        skip_bias = skip.bias.to(input.dtype) if skip.bias is not None else None
+        skip_output = F.conv1d(input, torch.cat([skip_weight[:, :first], skip_weight[:, last:]], dim=1))
+        skip_output += F.linear(planes, skip_weight[:, first:last, 0], skip_bias)[..., None]
+        
+        return self.main[1:](output) + skip_output
+
 class OutConvBlock(nn.Sequential):
     def __init__(self, c_in, c_mid, c_out, is_last=False, kernel_size=5):
         super().__init__(
@@ -109,6 +150,60 @@ class SelfAttention1d(nn.Module):
         self.qkv_proj = nn.Conv1d(c_in, c_in * 3, 1)
         self.out_proj = nn.Conv1d(c_in, c_in, 1)
         self.dropout = nn.Dropout(dropout_rate, inplace=True)
+        
+        # how the attention itself is computed, 'math' materializes the full [n, heads, s, s] scores
+        self.attention = AttentionType.MATH
+        self.query_chunk_size = 1024
+        
+        # 'local' only, approximate: keys within one window of each query's own window, plus pooled global tokens
+        self.window_size = 512
+        self.global_tokens = 0
+
+    def attend_local(self, q, k, v):
+        n, h, s, d = q.shape
+        w, g = self.window_size, self.global_tokens
+        scale = d**-0.25
+        blocks = -(-s // w)
+        pad = blocks * w - s
+        
+        # every block of w queries sees its own block and the one on either side, [n, h, blocks, w, 3w] scores
+        q = F.pad(q, (0, 0, 0, pad)).view([n, h, blocks, w, d]) * scale
+        k_local = F.pad(k, (0, 0, w, pad + w)).unfold(2, 3 * w, w) * scale
+        v_local = F.pad(v, (0, 0, w, pad + w)).unfold(2, 3 * w, w).transpose(3, 4)
+        
+        positions = torch.arange(blocks, device=q.device)[:, None] * w - w + torch.arange(3 * w, device=q.device)
+        scores = (q @ k_local).masked_fill(((positions < 0) | (positions >= s))[:, None], float('-inf'))
+        
+        if g > 0:
+            # the sequence averaged down to g keys and values that every query can reach
+            k_global = F.adaptive_avg_pool1d(k.transpose(2, 3).flatten(0, 1), g).view([n, h, 1, d, g]) * scale
+            v_global = F.adaptive_avg_pool1d(v.transpose(2, 3).flatten(0, 1), g).view([n, h, 1, d, g]).transpose(3, 4)
+            scores = torch.cat([scores, q @ k_global], dim=4)
+            v_local = torch.cat([v_local, v_global.expand(-1, -1, blocks, -1, -1)], dim=3)
+        
+        return (scores.softmax(4) @ v_local).view([n, h, blocks * w, d])[:, :, :s]
+
+    def attend(self, q, k, v):
+        if self.attention == AttentionType.SDPA and hasattr(F, 'scaled_dot_product_attention'):
+            return F.scaled_dot_product_attention(q, k, v)
+        
+        # every query scores 3 windows of keys, and with the padding and masking the exact
+        # scores stay faster on CPU up to about 4 windows, see scripts/benchmark_attention.py
+        if self.attention == AttentionType.LOCAL and q.shape[2] > 4 * self.window_size:
+            return self.attend_local(q, k, v)
+        
+        scale = k.shape[3]**-0.25
+        k = k.transpose(2, 3) * scale
+        
+        if self.attention == AttentionType.MATH:
+            return ((q * scale) @ k).softmax(3) @ v
+        
+        # chunked: only [n, heads, query_chunk_size, s] scores exist at a time
+        y = torch.empty_like(q)
+        for start in range(0, q.shape[2], self.query_chunk_size):
+            end = start + self.query_chunk_size
+            y[:, :, start:end] = ((q[:, :, start:end] * scale) @ k).softmax(3) @ v
+        return y
 
     def forward(self, input):
         n, c, s = input.shape
@@ -116,9 +211,7 @@ class SelfAttention1d(nn.Module):
         qkv = qkv.view(
             [n, self.n_head * 3, c // self.n_head, s]).transpose(2, 3)
         q, k, v = qkv.chunk(3, dim=1)
-        scale = k.shape[3]**-0.25
-        att = ((q * scale) @ (k.transpose(2, 3) * scale)).softmax(3)
-        y = (att @ v).transpose(2, 3).contiguous().view([n, c, s])
+        y = self.attend(q, k, v).transpose(2, 3).contiguous().view([n, c, s])
         return input + self.dropout(self.out_proj(y))
 
 class SelfAttentionMod1d(ConditionedModule):
@@ -143,13 +236,39 @@ class SelfAttentionMod1d(ConditionedModule):
         y = (att @ v).transpose(2, 3).contiguous().view([n, c, s])
         return input + self.out_proj(y)
 
+def is_compiling():
+    return hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling') and torch.compiler.is_compiling()
+
+
 class SkipBlock(nn.Module):
     def __init__(self, *main):
         super().__init__()
         self.main = nn.Sequential(*main)
+        
+        # when enabled, the output of main is kept, and reused instead of recomputed while `reuse_main` is set
+        self.cache_main = False
+        self.reuse_main = False
+        self.cached_main = None
+
+    def __getstate__(self):
+        # the cached features are scratch memory, not worth copying or sending to other processes
+        state = self.__dict__.copy()
+        state['cached_main'] = None
+        return state
+
+    def get_main(self, input):
+        if not self.cache_main or is_compiling():
+            return self.main(input)
+        
+        cached = self.cached_main
+        if self.reuse_main and cached is not None and cached.shape[0] == input.shape[0] and cached.shape[2] == input.shape[2] and cached.device == input.device:
+            return cached
+        
+        self.cached_main = self.main(input)
+        return self.cached_main
 
     def forward(self, input):
-        return torch.cat([self.main(input), input], dim=1)
+        return torch.cat([self.get_main(input), input], dim=1)
 
 class FourierFeatures(nn.Module):
     def __init__(self, in_features, out_features, std=1.):
@@ -180,6 +299,22 @@ _kernels = {
 }
 
 
+def get_depthwise_weight(module, x):
+    # the dense [C, C, K] weight was zero off the diagonal, so every channel is
+    # resampled on its own: a [C, 1, K] kernel with groups=C does the same work.
+    # Cached per shape, device and dtype, outside the state_dict. Compiled graphs
+    # build it inline, a cache filled while tracing fails the graph's guards.
+    if is_compiling():
+        return module.kernel.to(x)[None, None, :].expand([x.shape[1], 1, -1])
+    
+    key = (x.shape[1], x.device, x.dtype)
+    weight = module.depthwise_weights.get(key)
+    if weight is None:
+        weight = module.kernel.to(x)[None, None, :].repeat([x.shape[1], 1, 1])
+        module.depthwise_weights[key] = weight
+    return weight
+
+
 class Downsample1d(nn.Module):
     def __init__(self, kernel='linear', pad_mode='reflect'):
         super().__init__()
@@ -187,13 +322,11 @@ class Downsample1d(nn.Module):
         kernel_1d = torch.tensor(_kernels[kernel])
         self.pad = kernel_1d.shape[0] // 2 - 1
         self.register_buffer('kernel', kernel_1d)
+        self.depthwise_weights = {}
     
     def forward(self, x):
         x = F.pad(x, (self.pad,) * 2, self.pad_mode)
-        weight = x.new_zeros([x.shape[1], x.shape[1], self.kernel.shape[0]])
-        indices = torch.arange(x.shape[1], device=x.device)
-        weight[indices, indices] = self.kernel.to(weight)
-        return F.conv1d(x, weight, stride=2)
+        return F.conv1d(x, get_depthwise_weight(self, x), stride=2, groups=x.shape[1])
 
 
 class Upsample1d(nn.Module):
@@ -203,13 +336,11 @@ class Upsample1d(nn.Module):
         kernel_1d = torch.tensor(_kernels[kernel]) * 2
         self.pad = kernel_1d.shape[0] // 2 - 1
         self.register_buffer('kernel', kernel_1d)
+        self.depthwise_weights = {}
     
     def forward(self, x):
         x = F.pad(x, ((self.pad + 1) // 2,) * 2, self.pad_mode)
-        weight = x.new_zeros([x.shape[1], x.shape[1], self.kernel.shape[0]])
-        indices = torch.arange(x.shape[1], device=x.device)
-        weight[indices, indices] = self.kernel.to(weight)
-        return F.conv_transpose1d(x, weight, stride=2, padding=self.pad * 2 + 1)
+        return F.conv_transpose1d(x, get_depthwise_weight(self, x), stride=2, padding=self.pad * 2 + 1, groups=x.shape[1])
 
 def Downsample1d_2(
     in_channels: int, out_channels: int, factor: int, kernel_multiplier: int = 2
@@ -0,0 +1,118 @@
+import threading
+import torch
+from torch import nn
+
+
+def get_autocast_state(device_type: str) -> tuple:
+    if device_type == 'cpu':
+        return (torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype())
+    elif device_type == 'cuda':
+        return (torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype())
+    else:
+        return (False, None)
+
+
+def get_recompile_limit() -> int:
+    config = torch._dynamo.config
+    return getattr(config, 'recompile_limit', getattr(config, 'cache_size_limit', 8))
+
+
+class CompiledModel(nn.Module):
+    """
+        Runs the wrapped UNet through `torch.compile` for planned input lengths only,
+        the chunk size and the lengths `DDInference.plan_length` rounds to. Any other
+        length runs the eager module. The batch dimension is dynamic, so the shrinking
+        batches of early stopping, halved micro-batches and tiled window counts share
+        one graph per (length, dtype) and execution state (device, grad mode,
+        autocast), except batch size 1, which torch always specializes.
+
+        Graphs are built on the calling thread the first time their key is run, or
+        ahead of time through `warmup`, and compiling holds the same lock as every
+        forward, so the module is never traced while it runs. Once Dynamo's
+        recompile limit is reached, or for good if compilation fails, calls for new
+        keys run the eager module.
+    """
+    def __init__(self, module: nn.Module, mode: str = 'default', io_channels: int = 2):
+        super().__init__()
+        self.module = module
+        self.mode = mode
+        self.io_channels = io_channels
+
+        self.compiled = None
+        self.planned_lengths = set()
+        self.ready = set()
+        self.failed = set()
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        # compiled graphs and the lock stay with the process that built them
+        state = self.__dict__.copy()
+        state.update(compiled=None, ready=set(), failed=set(), lock=None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.lock = threading.RLock()
+
+    def get_key(self, batch_size: int, length: int, dtype: torch.dtype, device: torch.device) -> tuple:
+        return (min(batch_size, 2), length, dtype, device, torch.is_grad_enabled(), get_autocast_state(device.type))
+
+    def plan(self, length: int):
+        with self.lock:
+            self.planned_lengths.add(length)
+
+    def can_compile(self, key: tuple) -> bool:
+        if key in self.failed or key[1] not in self.planned_lengths:
+            return False
+
+        if len(self.ready) >= get_recompile_limit():
+            print(f"torch.compile already holds {len(self.ready)} graphs, the recompile limit, running {key[:3]} in eager mode.")
+            self.failed.add(key)
+            return False
+
+        return True
+
+    def run_compiled(self, key: tuple, input, t, *args, **kwargs):
+        if self.compiled is None:
+            self.compiled = torch.compile(self.module, mode=self.mode, dynamic=None)
+
+        if key[0] > 1:
+            torch._dynamo.mark_dynamic(input, 0)
+            torch._dynamo.mark_dynamic(t, 0)
+
+        output = self.compiled(input, t, *args, **kwargs)
+        self.ready.add(key)
+        return output
+
+    def warmup(
+        self,
+        batch_size: int,
+        length: int,
+        dtype: torch.dtype = torch.float32,
+        device: torch.device = None
+    ):
+        """
+            Plans `length` and compiles its graph for `batch_size` now, instead of on
+            the first sampler step.
+        """
+        device = next(self.module.parameters()).device if device is None else device
+
+        self.plan(length)
+        self.forward(
+            torch.zeros([batch_size, self.io_channels, length], dtype=dtype, device=device),
+            torch.zeros([batch_size], dtype=torch.float32, device=device)
+        )
+
+    def forward(self, input, t, *args, **kwargs):
+        key = self.get_key(input.shape[0], input.shape[2], input.dtype, input.device)
+
+        with self.lock:
+            if key in self.ready or (len(args) == 0 and len(kwargs) == 0 and self.can_compile(key)):
+                try:
+                    return self.run_compiled(key, input, t, *args, **kwargs)
+                except Exception as error:
+                    print(f"torch.compile failed for {key[:3]}, falling back to eager mode: {error}")
+                    self.ready.discard(key)
+                    self.failed.add(key)
+
+            return self.module(input, t, *args, **kwargs)
@@ -17,6 +17,12 @@ class DiffusionAttnUnet1D(nn.Module):
         super().__init__()
 
         self.timestep_embed = FourierFeatures(1, 16)
+        
+        # dtype the network runs in, set by the precision policy the model was loaded with
+        self.compute_dtype = torch.float32
+        
+        # the timestep planes are constant over the length, the first block can take them as a bias
+        self.fold_timestep_embed = True
 
         attn_layer = depth - n_attn_layers - 1
 
@@ -70,14 +76,35 @@ class DiffusionAttnUnet1D(nn.Module):
             for param in self.net.parameters():
                 param *= 0.5
 
+    def get_skip_blocks(self) -> list[SkipBlock]:
+        """
+            The nested SkipBlocks, outermost first. The main branch of the n-th from
+            the end holds the n deepest levels.
+        """
+        return [module for module in self.modules() if isinstance(module, SkipBlock)]
+
     def forward(self, input, t, cond=None):
-        timestep_embed = self.timestep_embed(t[:, None])[..., None].repeat([1, 1, input.shape[2]])
+        # the fourier features of t lose most of their precision in 16 bit, always embed in fp32
+        with torch.autocast(input.device.type, enabled=False):
+            timestep_embed = self.timestep_embed(t[:, None].float())
+        
+        if not self.fold_timestep_embed:
+            inputs = [input.to(self.compute_dtype), timestep_embed[..., None].repeat([1, 1, input.shape[2]]).to(self.compute_dtype)]
+            
+            if cond is not None:
+                cond = F.interpolate(cond, (input.shape[2], ), mode='linear', align_corners=False)
+                inputs.append(cond.to(self.compute_dtype))
+            
+            return self.net(torch.cat(inputs, dim=1)).to(input.dtype)
+        
+        x = input.to(self.compute_dtype)
         
-        inputs = [input, timestep_embed]
-
         if cond is not None:
             cond = F.interpolate(cond, (input.shape[2], ), mode='linear', align_corners=False)
-            inputs.append(cond)
-
-        return self.net(torch.cat(inputs, dim=1))
-    
\ No newline at end of file
+            x = torch.cat([x, cond.to(self.compute_dtype)], dim=1)
+        
+        x = self.net[0](x, timestep_embed.to(self.compute_dtype), input.shape[1])
+        for layer in self.net[1:]:
+            x = layer(x)
+        
+        return x.to(input.dtype)
@@ -1,6 +1,7 @@
 import torch
+from torch.nn import functional as F
 
-
+from contextlib import nullcontext
 from tqdm.auto import trange
 
 from diffusion.utils import t_to_alpha_sigma
@@ -10,9 +11,12 @@ from typing import Tuple, Callable
 from libs.diffusion_library.scheduler import SchedulerType
 from libs.diffusion_library.sampler import SamplerType
 from libs.dance_diffusion.base.model import ModelWrapperBase
-from libs.dance_diffusion.base.inference import InferenceBase
+from libs.dance_diffusion.base.inference import InferenceBase, StepProgress
+from libs.dance_diffusion.base.offload import BlockwiseOffloader
+from libs.dance_diffusion.dd.compiled import CompiledModel
 
-from libs.util.util import tensor_slerp_2D, PosteriorSampling
+from libs.util.util import tensor_slerp_batch, PosteriorSampling, RePaintSampling, TiledSampling, EarlyStopping, FeatureCaching
+from libs.util.cache import TensorCache, hash_tensor, hash_key
     
 class DDInference(InferenceBase):
     
@@ -22,318 +26,217 @@ class DDInference(InferenceBase):
         device_offload: torch.device = None,
         optimize_memory_use: bool = False,
         use_autocast: bool = True,
-        model: ModelWrapperBase = None
+        model: ModelWrapperBase = None,
+        memory_budget: int = None,
+        inversion_cache_path: str = None,
+        offloader: BlockwiseOffloader = None,
+        inversion_cache_max_bytes: int = 1024**3
     ):
-        super().__init__(device_accelerator, device_offload, optimize_memory_use, use_autocast, model)
+        super().__init__(device_accelerator, device_offload, optimize_memory_use, use_autocast, model, memory_budget, offloader)
         
-    def generate(
+        # reverse-sampled latents of interpolation endpoints, reused across position sweeps
+        self.inversion_cache = TensorCache(max_entries=16, spill_path=inversion_cache_path, max_spill_bytes=inversion_cache_max_bytes)
+    
+    def warmup(
         self,
-        callback: Callable = None,
-        batch_size: int = None,
-        seed: int = None,
-        steps: int = None,
-        scheduler: SchedulerType = None,
-        scheduler_args: dict = None,
-        sampler: SamplerType = None,
-        sampler_args: dict = None,
-        **kwargs
+        batch_size: int = 1,
+        length: int = None
     ):
-        self.generator.manual_seed(seed)
+        """
+            Compiles the UNet for a (batch_size, length) input under the same autocast
+            state sampling will use. Does nothing for eager models.
+        """
+        if not isinstance(self.model.model, CompiledModel):
+            return
         
-        step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)#step_list = step_list[:-1] if sampler in [SamplerType.V_PRK, SamplerType.V_PLMS, SamplerType.V_PIE, SamplerType.V_PLMS2, SamplerType.V_IPLMS] else step_list
+        length = self.model.chunk_size if length is None else length
+        autocast = self.autocast_context() if self.use_autocast else nullcontext()
         
-        if SamplerType.is_v_sampler(sampler):
-            x_T = torch.randn([batch_size, 2, self.model.chunk_size], generator=self.generator, device=self.device_accelerator)
-            model = self.model.model
-        else:
-            x_T = step_list[0] * torch.randn([batch_size, 2, self.model.chunk_size], generator=self.generator, device=self.device_accelerator)
-            model = VDenoiser(self.model.model)
+        with autocast, torch.no_grad():
+            self.model.model.warmup(batch_size, length, device=self.device_accelerator)
         
-        with self.offload_context(self.model.model):
-            return sampler.sample(
-                model,
-                x_T,
-                step_list,
-                callback,
-                **sampler_args
-            ).float()
-            
-            
-    def generate_variation(
+    def plan_length(
         self,
-        callback: Callable = None,
-        batch_size: int = None,
-        seed: int = None,
-        audio_source: torch.Tensor = None,
-        expansion_map: list[int] = None,
-        noise_level: float = None,
-        steps: int = None,
-        scheduler: SchedulerType = None,
-        scheduler_args = None,
-        sampler: SamplerType = None,
-        sampler_args = None,
-        **kwargs
+        length: int
+    ) -> int:
+        """
+            The smallest length at or above `length` that the UNet accepts, never below
+            its minimum length. Inputs are zero padded to it and outputs trimmed back,
+            instead of paying for a full chunk. Compiled graphs are only built for the
+            lengths planned here, and rounding bounds how many there can be.
+        """
+        multiple = self.model.get_length_multiple()
+        length = max(-(-length // multiple) * multiple, self.model.get_min_length())
+        
+        if isinstance(self.model.model, CompiledModel):
+            self.model.model.plan(length)
+        
+        return length
+    
+    def with_early_stopping(
+        self,
+        model: Callable,
+        sampler: SamplerType,
+        early_stopping_args: dict = None
+    ) -> Callable:
+        if early_stopping_args == None or early_stopping_args.get('threshold', 0.0) <= 0.0:
+            return model
+        
+        return EarlyStopping(
+            model,
+            early_stopping_args['threshold'],
+            early_stopping_args.get('patience', 3),
+            SamplerType.is_v_sampler(sampler)
+        )
+    
+    def with_feature_cache(
+        self,
+        model: Callable,
+        feature_cache_args: dict = None
+    ) -> Callable:
+        if feature_cache_args == None or feature_cache_args.get('levels', 0) <= 0 or feature_cache_args.get('interval', 1) <= 1:
+            return model
+        
+        # compiled graphs always run the full network
+        if self.model.use_compile:
+            return model
+        
+        blocks = self.model.module.diffusion_ema.get_skip_blocks()
+        
+        return FeatureCaching(
+            model,
+            blocks[-min(feature_cache_args['levels'], len(blocks))],
+            feature_cache_args['interval']
+        )
+    
+    def sample_with_early_stopping(
+        self,
+        model: Callable,
+        x_T: torch.Tensor,
+        step_list: torch.Tensor,
+        callback: Callable,
+        sampler: SamplerType,
+        sampler_args: dict,
+        early_stopping_args: dict = None,
+        feature_cache_args: dict = None
     ) -> torch.Tensor:
-        self.generator.manual_seed(seed)
-        
-        audio_source = self.expand(audio_source, expansion_map)
-        
-        if SamplerType.is_v_sampler(sampler):
-            step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
-            step_list = step_list[step_list < noise_level]
-            alpha_T, sigma_T = t_to_alpha_sigma(step_list[0])
-            x_T = alpha_T * audio_source + sigma_T * torch.randn(audio_source.shape, device=audio_source.device, generator=self.generator)
-            model = self.model.model
+        # early stopping outside, a smaller batch of remaining items just refreshes the features
+        feature_cache = self.with_feature_cache(model, feature_cache_args)
+        model = self.with_early_stopping(feature_cache, sampler, early_stopping_args)
+        
+        try:
+            result = sampler.sample(model, x_T, step_list, callback, **sampler_args)
+        finally:
+            if isinstance(feature_cache, FeatureCaching):
+                feature_cache.remove()
+        
+        if isinstance(model, EarlyStopping):
+            self.steps_skipped += model.steps_skipped
+            self.item_steps_skipped += model.item_steps_skipped.tolist()
         else:
-            scheduler_args.update(sigma_max = scheduler_args.get('sigma_max', 1.0) * noise_level)
-            step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
-            x_T = audio_source + step_list[0] * torch.randn(audio_source.shape, device=audio_source.device, generator=self.generator)
-            model = VDenoiser(self.model.model)
+            self.item_steps_skipped += [0] * x_T.shape[0]
         
-        with self.offload_context(self.model.model):
-            return sampler.sample(
-                model,
-                x_T,
-                step_list,
-                callback,
-                **sampler_args
-            ).float()
-            
-            
-    def generate_interpolation(
+        return result
+        
+    def generate(
         self,
         callback: Callable = None,
         batch_size: int = None,
-        # seed: int = None,
-        interpolation_positions: list[float] = None,
-        audio_source: torch.Tensor = None,
-        audio_target: torch.Tensor = None,
-        expansion_map: list[int] = None,
-        noise_level: float = None,
+        seed: int = None,
         steps: int = None,
         scheduler: SchedulerType = None,
-        scheduler_args = None,
+        scheduler_args: dict = None,
         sampler: SamplerType = None,
-        sampler_args = None,
+        sampler_args: dict = None,
+        sample_seeds: list[int] = None,
+        early_stopping_args: dict = None,
+        feature_cache_args: dict = None,
         **kwargs
-        ) -> torch.Tensor:
+    ):
+        sample_seeds = self.get_sample_seeds(seed, batch_size, sample_seeds)
+        
+        step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)#step_list = step_list[:-1] if sampler in [SamplerType.V_PRK, SamplerType.V_PLMS, SamplerType.V_PIE, SamplerType.V_PLMS2, SamplerType.V_IPLMS] else step_list
+        callback = self.track_progress(callback, batch_size * StepProgress.get_steps(step_list))
         
         if SamplerType.is_v_sampler(sampler):
-            step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
-            step_list = step_list[step_list < noise_level]
-            step_list[-1] += 1e-7 #HACK avoid division by 0 in reverse sampling
+            noise_scale = 1.0
             model = self.model.model
         else:
-            scheduler_args.update(sigma_max = scheduler_args.get('sigma_max', 1.0) * noise_level)
-            step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
-            step_list = step_list[:-1] #HACK avoid division by 0 in reverse sampling
+            noise_scale = step_list[0]
             model = VDenoiser(self.model.model)
         
-        if self.optimize_memory_use and batch_size < 2:
-            x_0_source = audio_source
-            x_0_target = audio_target
+        def sample_micro_batch(start: int, end: int) -> torch.Tensor:
+            generators = self.get_generators(sample_seeds[start:end])
+            x_T = noise_scale * self.cc_randn([end - start, 2, self.model.chunk_size], generators)
             
-            with self.offload_context(self.model.model):
-                x_T_source = sampler.sample(
-                    model,
-                    x_0_source,
-                    step_list.flip(0),
-                    callback,
-                    **sampler_args
-                )
-            
-            with self.offload_context(self.model.model):
-                x_T_target = sampler.sample(
-                    model,
-                    x_0_target,
-                    step_list.flip(0),
-                    callback,
-                    **sampler_args
-                )
-            
-            x_T = torch.cat([x_T_source, x_T_target], dim=0)
-        else:
-            x_0 = torch.cat([audio_source, audio_target], dim=0)
-            
-            with self.offload_context(self.model.model):
-                x_T = sampler.sample(
-                    model,
-                    x_0,
-                    step_list.flip(0),
-                    callback,
-                    **sampler_args
-                )
-        
-        if SamplerType.is_v_sampler(sampler): #HACK reset schedule after hack
-            step_list[-1] = 0.0
-        else:
-            step_list = torch.cat([step_list, step_list.new_zeros([1])])
-        
-        x_Int = torch.empty([batch_size, 2, self.model.chunk_size], device=self.device_accelerator)
-        
-        for pos in range(len(interpolation_positions)):
-            x_Int[pos] = tensor_slerp_2D(x_T[0], x_T[1], interpolation_positions[pos])
-        
-        with self.offload_context(self.model.model):
-            return sampler.sample(
+            return self.sample_with_early_stopping(
                 model,
-                x_Int,
+                x_T,
                 step_list,
-                callback,
-                **sampler_args
+                self.phase_callback(callback, step_list, start, end),
+                sampler,
+                self.with_noise_sampler(sampler_args, x_T, generators),
+                early_stopping_args,
+                feature_cache_args
             ).float()
-            
-
-    def generate_inpainting(
-        self,
-        callback: Callable = None,
-        batch_size: int = None,
-        seed: int = None,
-        audio_source: torch.Tensor = None,
-        expansion_map: list[int] = None,
-        mask: torch.Tensor = None,
-        steps: int = None,
-        scheduler: SchedulerType = None,
-        scheduler_args = None,
-        sampler: SamplerType = None,
-        sampler_args = None,
-        inpainting_args = None,
-        **kwargs
-    ) -> torch.Tensor:
-        
-        self.generator.manual_seed(seed)
         
-        method = inpainting_args.get('method')
-        
-        if(method == 'repaint'):
-            raise Exception("Repaint currently not supported due to changed requirements")
+        with self.offload_context(self.model.model):
+            return self.sample_batched(batch_size, sample_micro_batch, self.model.get_sample_memory(self.model.chunk_size))
             
-        elif(method == 'posterior_guidance'):
-            step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
             
-            if SamplerType.is_v_sampler(sampler):
-                raise Exception('V-Sampler currently not supported for posterior guidance. Please choose a K-Sampler.')
-            else:
-                x_T = audio_source + step_list[0] * torch.randn([batch_size, 2, self.model.chunk_size], generator=self.generator, device=self.device_accelerator)
-                model = PosteriorSampling(
-                    VDenoiser(self.model.model),
-                    x_T,
-                    audio_source,
-                    mask,
-                    inpainting_args.get('posterior_guidance_scale')
-                )
-                
-                with self.offload_context(self.model.model):
-                    return sampler.sample(
-                        model,
-                        x_T,
-                        step_list,
-                        callback,
-                        **sampler_args
-                    ).float()
-                
-                    
-    def generate_extension(
-        self,
-        callback: Callable = None,
-        batch_size: int = None,
-        seed: int = None,
-        audio_source: torch.Tensor = None,
-        expansion_map: list[int] = None,
-        steps: int = None,
-        scheduler: SchedulerType = None,
-        scheduler_args = None,
-        sampler: SamplerType = None,
-        sampler_args = None,
-        inpainting_args = None,
-        keep_start: bool = None,
-        **kwargs
-    ) -> torch.Tensor:
-        
-        half_chunk_size = self.model.chunk_size // 2
-        chunk = torch.cat([audio_source[:, :, -half_chunk_size:], torch.zeros([batch_size, 2, half_chunk_size], device=self.device_accelerator)], dim=2)
-        #chunk = audio_source
-        
-        mask = torch.cat(
-            [torch.ones([batch_size, 2, half_chunk_size], dtype=torch.bool, device=self.device_accelerator),
-            torch.zeros([batch_size, 2, half_chunk_size], dtype=torch.bool, device=self.device_accelerator)],
-            dim=2 
-        )
-        
-        output = self.generate_inpainting(
-            callback,
-            batch_size,
-            seed,
-            chunk,
-            expansion_map,
-            mask,
-            steps,
-            scheduler,
-            scheduler_args,
-            sampler,
-            sampler_args,
-            inpainting_args
-        )
-        
-        if (keep_start):
-            return torch.cat(
-                [audio_source,
-                 output[:, :, -half_chunk_size:]],
-                dim=2
-            )
-        else:
-            return output[:, :, -half_chunk_size:]
-from typing import Tuple, Callable
-from libs.diffusion_library.scheduler import SchedulerType
-from libs.diffusion_library.sampler import SamplerType
-from libs.dance_diffusion.base.model import ModelWrapperBase
-from libs.dance_diffusion.base.inference import InferenceBase
-
-from libs.util.util import tensor_slerp_2D, PosteriorSampling
-    
-class DDInference(InferenceBase):
-    
-    def __init__(
-        self,
-        device_accelerator: torch.device = None,
-        device_offload: torch.device = None,
-        optimize_memory_use: bool = False,
-        use_autocast: bool = True,
-        model: ModelWrapperBase = None
-    ):
-        super().__init__(device_accelerator, device_offload, optimize_memory_use, use_autocast, model)
-        
-    def generate(
+    def generate_long(
         self,
         callback: Callable = None,
         batch_size: int = None,
         seed: int = None,
+        length: int = None,
+        overlap: int = None,
         steps: int = None,
         scheduler: SchedulerType = None,
         scheduler_args: dict = None,
         sampler: SamplerType = None,
         sampler_args: dict = None,
+        sample_seeds: list[int] = None,
+        early_stopping_args: dict = None,
+        feature_cache_args: dict = None,
         **kwargs
-    ):
-        self.generator.manual_seed(seed)
+    ) -> torch.Tensor:
+        sample_seeds = self.get_sample_seeds(seed, batch_size, sample_seeds)
         
-        step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)#step_list = step_list[:-1] if sampler in [SamplerType.V_PRK, SamplerType.V_PLMS, SamplerType.V_PIE, SamplerType.V_PLMS2, SamplerType.V_IPLMS] else step_list
+        chunk_size = self.model.chunk_size
+        overlap = chunk_size // 4 if overlap is None else overlap
+        latent_length = TiledSampling.get_latent_length(length, chunk_size, overlap)
+        
+        step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
+        callback = self.track_progress(callback, batch_size * StepProgress.get_steps(step_list))
+        tiled_model = TiledSampling(self.model.model, chunk_size, overlap)
         
         if SamplerType.is_v_sampler(sampler):
-            x_T = torch.randn([batch_size, 2, self.model.chunk_size], generator=self.generator, device=self.device_accelerator)
-            model = self.model.model
+            noise_scale = 1.0
+            model = tiled_model
         else:
-            x_T = step_list[0] * torch.randn([batch_size, 2, self.model.chunk_size], generator=self.generator, device=self.device_accelerator)
-            model = VDenoiser(self.model.model)
+            noise_scale = step_list[0]
+            model = VDenoiser(tiled_model)
         
-        with self.offload_context(self.model.model):
-            return sampler.sample(
+        def sample_micro_batch(start: int, end: int) -> torch.Tensor:
+            generators = self.get_generators(sample_seeds[start:end])
+            x_T = noise_scale * self.cc_randn([end - start, 2, latent_length], generators)
+            
+            return self.sample_with_early_stopping(
                 model,
                 x_T,
                 step_list,
-                callback,
-                **sampler_args
-            ).float()
+                self.phase_callback(callback, step_list, start, end),
+                sampler,
+                self.with_noise_sampler(sampler_args, x_T, generators),
+                early_stopping_args,
+                feature_cache_args
+            ).float()[:, :, :length]
+        
+        n_windows = (latent_length - overlap) // (chunk_size - overlap)
+        
+        with self.offload_context(self.model.model):
+            return self.sample_batched(batch_size, sample_micro_batch, n_windows * self.model.get_sample_memory(chunk_size))
             
             
     def generate_variation(
@@ -349,32 +252,50 @@ class DDInference(InferenceBase):
         scheduler_args = None,
         sampler: SamplerType = None,
         sampler_args = None,
+        sample_seeds: list[int] = None,
+        early_stopping_args: dict = None,
+        feature_cache_args: dict = None,
         **kwargs
     ) -> torch.Tensor:
-        self.generator.manual_seed(seed)
-        
         audio_source = self.expand(audio_source, expansion_map)
+        batch_size = audio_source.shape[0]
+        sample_seeds = self.get_sample_seeds(seed, batch_size, sample_seeds)
+        
+        source_length = audio_source.shape[2]
+        audio_source = F.pad(audio_source, (0, self.plan_length(source_length) - source_length))
         
         if SamplerType.is_v_sampler(sampler):
             step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
             step_list = step_list[step_list < noise_level]
             alpha_T, sigma_T = t_to_alpha_sigma(step_list[0])
-            x_T = alpha_T * audio_source + sigma_T * torch.randn(audio_source.shape, device=audio_source.device, generator=self.generator)
             model = self.model.model
         else:
             scheduler_args.update(sigma_max = scheduler_args.get('sigma_max', 1.0) * noise_level)
             step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
-            x_T = audio_source + step_list[0] * torch.randn(audio_source.shape, device=audio_source.device, generator=self.generator)
+            alpha_T, sigma_T = 1.0, step_list[0]
             model = VDenoiser(self.model.model)
         
-        with self.offload_context(self.model.model):
-            return sampler.sample(
+        # the noise level truncates the schedule
+        callback = self.track_progress(callback, batch_size * StepProgress.get_steps(step_list))
+        
+        def sample_micro_batch(start: int, end: int) -> torch.Tensor:
+            generators = self.get_generators(sample_seeds[start:end])
+            x_0 = audio_source[start:end]
+            x_T = alpha_T * x_0 + sigma_T * self.cc_randn_like(x_0, generators)
+            
+            return self.sample_with_early_stopping(
                 model,
                 x_T,
                 step_list,
-                callback,
-                **sampler_args
-            ).float()
+                self.phase_callback(callback, step_list, start, end),
+                sampler,
+                self.with_noise_sampler(sampler_args, x_T, generators),
+                early_stopping_args,
+                feature_cache_args
+            ).float()[:, :, :source_length]
+        
+        with self.offload_context(self.model.model):
+            return self.sample_batched(batch_size, sample_micro_batch, self.model.get_sample_memory(audio_source.shape[2]))
             
             
     def generate_interpolation(
@@ -392,9 +313,24 @@ class DDInference(InferenceBase):
         scheduler_args = None,
         sampler: SamplerType = None,
         sampler_args = None,
+        early_stopping_args: dict = None,
+        feature_cache_args: dict = None,
         **kwargs
         ) -> torch.Tensor:
         
+        # keyed on the arguments as passed, the K branch below rescales sigma_max in place
+        get_inversion_key = lambda audio: hash_key(
+            hash_tensor(audio),
+            self.model.get_cache_key(),
+            sampler.value,
+            scheduler.value,
+            sorted(scheduler_args.items()),
+            sorted((key, value) for key, value in sampler_args.items() if isinstance(value, (bool, int, float, str))),
+            steps,
+            noise_level
+        )
+        inversion_keys = [get_inversion_key(audio_source), get_inversion_key(audio_target)]
+        
         if SamplerType.is_v_sampler(sampler):
             step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
             step_list = step_list[step_list < noise_level]
@@ -406,58 +342,54 @@ class DDInference(InferenceBase):
             step_list = step_list[:-1] #HACK avoid division by 0 in reverse sampling
             model = VDenoiser(self.model.model)
         
-        if self.optimize_memory_use and batch_size < 2:
-            x_0_source = audio_source
-            x_0_target = audio_target
-            
-            with self.offload_context(self.model.model):
-                x_T_source = sampler.sample(
-                    model,
-                    x_0_source,
-                    step_list.flip(0),
-                    callback,
-                    **sampler_args
-                )
+        x_0 = [audio_source, audio_target]
+        x_T = [self.inversion_cache.get(key, self.device_accelerator) for key in inversion_keys]
+        missing = [index for index, x in enumerate(x_T) if x is None]
+        
+        # clips that were not inverted before run as one batch, or one by one when memory is tight
+        groups = [[index] for index in missing] if (self.optimize_memory_use and batch_size < 2) else [missing]
+        
+        # inverting the missing clips runs the schedule too, the K schedule gets its last step back below
+        inversion_steps = StepProgress.get_steps(step_list)
+        sampling_steps = inversion_steps if SamplerType.is_v_sampler(sampler) else inversion_steps + 1
+        callback = self.track_progress(callback, len(missing) * inversion_steps + len(interpolation_positions) * sampling_steps)
+        
+        for group in groups:
+            if len(group) == 0:
+                continue
             
             with self.offload_context(self.model.model):
-                x_T_target = sampler.sample(
+                x_T_group = sampler.sample(
                     model,
-                    x_0_target,
+                    torch.cat([x_0[index] for index in group], dim=0),
                     step_list.flip(0),
-                    callback,
+                    self.phase_callback(callback, step_list, 0, len(group)),
                     **sampler_args
                 )
             
-            x_T = torch.cat([x_T_source, x_T_target], dim=0)
-        else:
-            x_0 = torch.cat([audio_source, audio_target], dim=0)
-            
-            with self.offload_context(self.model.model):
-                x_T = sampler.sample(
-                    model,
-                    x_0,
-                    step_list.flip(0),
-                    callback,
-                    **sampler_args
-                )
+            for index, x in zip(group, x_T_group.split(1, dim=0)):
+                x_T[index] = x
+                self.inversion_cache.put(inversion_keys[index], x)
+        
+        x_T = torch.cat(x_T, dim=0)
         
         if SamplerType.is_v_sampler(sampler): #HACK reset schedule after hack
             step_list[-1] = 0.0
         else:
             step_list = torch.cat([step_list, step_list.new_zeros([1])])
         
-        x_Int = torch.empty([batch_size, 2, self.model.chunk_size], device=self.device_accelerator)
-        
-        for pos in range(len(interpolation_positions)):
-            x_Int[pos] = tensor_slerp_2D(x_T[0], x_T[1], interpolation_positions[pos])
+        x_Int = tensor_slerp_batch(x_T[0], x_T[1], interpolation_positions)
         
         with self.offload_context(self.model.model):
-            return sampler.sample(
+            return self.sample_with_early_stopping(
                 model,
                 x_Int,
                 step_list,
-                callback,
-                **sampler_args
+                self.phase_callback(callback, step_list, 0, x_Int.shape[0]),
+                sampler,
+                sampler_args,
+                early_stopping_args,
+                feature_cache_args
             ).float()
             
 
@@ -475,40 +407,81 @@ class DDInference(InferenceBase):
         sampler: SamplerType = None,
         sampler_args = None,
         inpainting_args = None,
+        resamples: int = None,
+        sample_seeds: list[int] = None,
         **kwargs
     ) -> torch.Tensor:
         
-        self.generator.manual_seed(seed)
+        sample_seeds = self.get_sample_seeds(seed, batch_size, sample_seeds)
         
         method = inpainting_args.get('method')
         
         if(method == 'repaint'):
-            raise Exception("Repaint currently not supported due to changed requirements")
+            step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
+            callback = self.track_progress(callback, batch_size * StepProgress.get_steps(step_list))
+            
+            if SamplerType.is_v_sampler(sampler):
+                noise_scale = 1.0
+                model = self.model.model
+            else:
+                noise_scale = step_list[0]
+                model = VDenoiser(self.model.model)
+            
+            def sample_micro_batch(start: int, end: int) -> torch.Tensor:
+                generators = self.get_generators(sample_seeds[start:end])
+                x_T = noise_scale * self.cc_randn([end - start, 2, self.model.chunk_size], generators)
+                repaint_model = RePaintSampling(
+                    model,
+                    self.slice_batch(audio_source, start, end, batch_size),
+                    self.slice_batch(mask, start, end, batch_size),
+                    self.cc_randn_like(x_T, generators),
+                    resamples if resamples else 1,
+                    SamplerType.is_v_sampler(sampler),
+                    lambda x: self.cc_randn_like(x, generators)
+                )
+                
+                return sampler.sample(
+                    repaint_model,
+                    x_T,
+                    step_list,
+                    self.phase_callback(callback, step_list, start, end),
+                    **self.with_noise_sampler(sampler_args, x_T, generators)
+                ).float()
+            
+            with self.offload_context(self.model.model):
+                return self.sample_batched(batch_size, sample_micro_batch, self.model.get_sample_memory(self.model.chunk_size))
             
         elif(method == 'posterior_guidance'):
             step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
+            callback = self.track_progress(callback, batch_size * StepProgress.get_steps(step_list))
             
             if SamplerType.is_v_sampler(sampler):
                 raise Exception('V-Sampler currently not supported for posterior guidance. Please choose a K-Sampler.')
             else:
-                x_T = audio_source + step_list[0] * torch.randn([batch_size, 2, self.model.chunk_size], generator=self.generator, device=self.device_accelerator)
-                model = PosteriorSampling(
-                    VDenoiser(self.model.model),
-                    x_T,
-                    audio_source,
-                    mask,
-                    inpainting_args.get('posterior_guidance_scale')
-                )
-                
-                with self.offload_context(self.model.model):
+                def sample_micro_batch(start: int, end: int) -> torch.Tensor:
+                    generators = self.get_generators(sample_seeds[start:end])
+                    x_0 = self.slice_batch(audio_source, start, end, batch_size)
+                    x_T = x_0 + step_list[0] * self.cc_randn([end - start, 2, self.model.chunk_size], generators)
+                    model = PosteriorSampling(
+                        VDenoiser(self.model.model),
+                        x_T,
+                        x_0,
+                        self.slice_batch(mask, start, end, batch_size),
+                        inpainting_args.get('posterior_guidance_scale')
+                    )
+                    
                     return sampler.sample(
                         model,
                         x_T,
                         step_list,
-                        callback,
-                        **sampler_args
+                        self.phase_callback(callback, step_list, start, end),
+                        **self.with_noise_sampler(sampler_args, x_T, generators)
                     ).float()
                 
+                with self.offload_context(self.model.model):
+                    # posterior guidance backpropagates through the model, roughly tripling its footprint
+                    return self.sample_batched(batch_size, sample_micro_batch, 3 * self.model.get_sample_memory(self.model.chunk_size))
+                
                     
     def generate_extension(
         self,
@@ -524,39 +497,75 @@ class DDInference(InferenceBase):
         sampler_args = None,
         inpainting_args = None,
         keep_start: bool = None,
+        length: int = None,
+        crossfade: int = None,
+        resamples: int = None,
+        sample_seeds: list[int] = None,
         **kwargs
     ) -> torch.Tensor:
+        """
+            Continues `audio_source` by `length` samples (half a chunk by default),
+            one segment at a time: every segment inpaints the second half of a chunk
+            whose first half is the last half chunk written so far. The last
+            `crossfade` samples of that half are regenerated too, and the audio
+            written so far fades into them before the boundary.
+        """
+        audio_source = self.expand(audio_source, expansion_map)
+        batch_size = audio_source.shape[0]
+        sample_seeds = self.get_sample_seeds(seed, batch_size, sample_seeds)
         
-        half_chunk_size = self.model.chunk_size // 2
-        chunk = torch.cat([audio_source[:, :, -half_chunk_size:], torch.zeros([batch_size, 2, half_chunk_size], device=self.device_accelerator)], dim=2)
-        #chunk = audio_source
+        chunk_size = self.model.chunk_size
+        context_size = chunk_size // 2
+        segment_size = chunk_size - context_size
+        length = segment_size if length is None else length
+        crossfade = min(chunk_size // 32 if crossfade is None else crossfade, context_size)
+        n_segments = -(-length // segment_size)
         
-        mask = torch.cat(
-            [torch.ones([batch_size, 2, half_chunk_size], dtype=torch.bool, device=self.device_accelerator),
-            torch.zeros([batch_size, 2, half_chunk_size], dtype=torch.bool, device=self.device_accelerator)],
-            dim=2 
-        )
+        prefix = audio_source if keep_start else audio_source[:, :, -context_size:]
+        prefix_size = prefix.shape[2]
         
-        output = self.generate_inpainting(
-            callback,
-            batch_size,
-            seed,
-            chunk,
-            expansion_map,
-            mask,
-            steps,
-            scheduler,
-            scheduler_args,
-            sampler,
-            sampler_args,
-            inpainting_args
-        )
+        result = torch.empty([batch_size, 2, prefix_size + n_segments * segment_size], device=self.device_accelerator)
+        result[:, :, :prefix_size] = prefix
         
-        if (keep_start):
-            return torch.cat(
-                [audio_source,
-                 output[:, :, -half_chunk_size:]],
-                dim=2
+        # the known part and its mask are the same for every segment
+        chunk = torch.zeros([batch_size, 2, chunk_size], device=self.device_accelerator)
+        mask = torch.zeros([batch_size, 2, chunk_size], dtype=torch.bool, device=self.device_accelerator)
+        mask[:, :, :context_size - crossfade] = True
+        
+        fade = (torch.arange(crossfade, device=self.device_accelerator) + 0.5) / crossfade
+        
+        # every segment runs the whole schedule again, one tracker spans them all
+        step_list = scheduler.get_step_list(steps, self.device_accelerator.type, **scheduler_args)
+        callback = self.track_progress(callback, n_segments * batch_size * StepProgress.get_steps(step_list))
+        
+        position = prefix_size
+        for segment in range(n_segments):
+            chunk[:, :, :context_size] = result[:, :, position - context_size:position]
+            
+            output = self.generate_inpainting(
+                callback=callback,
+                batch_size=batch_size,
+                seed=seed,
+                audio_source=chunk,
+                mask=mask,
+                steps=steps,
+                scheduler=scheduler,
+                scheduler_args=dict(scheduler_args),
+                sampler=sampler,
+                sampler_args=sampler_args,
+                inpainting_args=inpainting_args,
+                resamples=resamples,
+                # segment 0 keeps the seeds of a single extension call, later ones only depend on the item's seed
+                sample_seeds=sample_seeds if segment == 0 else [int(hash_key(sample_seed, segment)[:8], 16) for sample_seed in sample_seeds]
             )
+            
+            if crossfade > 0:
+                result[:, :, position - crossfade:position].lerp_(output[:, :, context_size - crossfade:context_size], fade)
+            result[:, :, position:position + segment_size] = output[:, :, context_size:]
+            
+            position += segment_size
+        
+        if (keep_start):
+            return result[:, :, :prefix_size + length]
         else:
-            return output[:, :, -half_chunk_size:]
+            return result[:, :, prefix_size:prefix_size + length]
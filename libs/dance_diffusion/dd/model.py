@@ -1,10 +1,15 @@
+import os
 import torch
 from torch import nn
 from typing import Callable
 
 from .ddattnunet import DiffusionAttnUnet1D
+from .compiled import CompiledModel
 from libs.dance_diffusion.base.model import ModelWrapperBase
-from libs.dance_diffusion.base.type import ModelType
+from libs.dance_diffusion.base.type import ModelType, PrecisionType, AttentionType
+from libs.dance_diffusion.base.precision import apply_precision
+from libs.dance_diffusion.base.quantization import quantize_convs
+from .blocks import FourierFeatures, SkipBlock, SelfAttention1d
 
 
 class DanceDiffusionInference(nn.Module):
@@ -13,6 +18,18 @@ class DanceDiffusionInference(nn.Module):
 
         self.diffusion_ema = DiffusionAttnUnet1D(kwargs, n_attn_layers=n_attn_layers)
 
+def quantize_unet(unet: DiffusionAttnUnet1D) -> DiffusionAttnUnet1D:
+    """
+        Quantizes the convolutions of every ResConvBlock and the attention projections
+        to int8. The first convolution, which sees the raw audio and timestep planes,
+        and the last block's convolution and skip, which produce the output, stay
+        in fp32.
+    """
+    keep = [unet.net[0].main[0], unet.net[-1].main[3], unet.net[-1].skip]
+    convs = [module for module in unet.net.modules() if isinstance(module, nn.Conv1d) and module not in keep]
+    
+    return quantize_convs(unet, convs)
+
 class DDModelWrapper(ModelWrapperBase):
     def __init__(self):
         
@@ -20,6 +37,10 @@ class DDModelWrapper(ModelWrapperBase):
         
         self.module:DanceDiffusionInference = None
         self.model:Callable = None
+        self.attention:AttentionType = AttentionType.MATH
+        self.attention_window:int = 512
+        self.attention_global_tokens:int = 0
+        self.use_compile:bool = False
         
     def load(
         self,
@@ -27,7 +48,12 @@ class DDModelWrapper(ModelWrapperBase):
         device_accelerator:torch.device,
         optimize_memory_use:bool=False,
         chunk_size:int=None,
-        sample_rate:int=None
+        sample_rate:int=None,
+        use_compile:bool=False,
+        precision:PrecisionType=PrecisionType.FP32,
+        attention:AttentionType=AttentionType.MATH,
+        attention_window:int=512,
+        attention_global_tokens:int=0
     ):
         
         default_model_config = dict(
@@ -44,7 +70,15 @@ class DDModelWrapper(ModelWrapperBase):
             )
         )
         
-        file = torch.load(path, map_location='cpu')
+        if precision == PrecisionType.INT8 and device_accelerator.type != 'cpu':
+            print(f"int8 quantization only runs on CPU, loading {path} in fp32 instead.")
+            precision = PrecisionType.FP32
+        
+        # the quantized state_dict is cached next to the checkpoint, and rebuilt when the checkpoint is newer
+        quantized_path = f"{path}.int8.pt"
+        use_quantized_cache = precision == PrecisionType.INT8 and os.path.isfile(quantized_path) and os.path.getmtime(quantized_path) >= os.path.getmtime(path)
+        
+        file = torch.load(quantized_path if use_quantized_cache else path, map_location='cpu')
         
         model_config = file.get('model_config')
         if not model_config:
@@ -59,17 +93,115 @@ class DDModelWrapper(ModelWrapperBase):
         self.chunk_size =  model_info.get('native_chunk_size')if not chunk_size else chunk_size
         self.sample_rate = model_info.get('sample_rate')if not sample_rate else sample_rate
         
-        self.module = DanceDiffusionInference(
+        build_module = lambda: DanceDiffusionInference(
             n_attn_layers=diffusion_config.get('n_attn_layers'),
             sample_size=chunk_size,
             sample_rate=sample_rate,
             latent_dim=0,
         )
+        self.module = build_module()
         
-        self.module.load_state_dict(
-            file["state_dict"], 
-            strict=False
-        )
+        if use_quantized_cache:
+            quantize_unet(self.module.diffusion_ema)
+            
+            # written from this very module, so it has to match exactly, otherwise it is stale
+            try:
+                self.module.load_state_dict(file["state_dict"])
+            except RuntimeError as error:
+                print(f"The int8 cache {quantized_path} does not match the model, rebuilding it: {error}")
+                use_quantized_cache = False
+                file = torch.load(path, map_location='cpu')
+                self.module = build_module()
+        
+        if not use_quantized_cache:
+            self.module.load_state_dict(
+                file["state_dict"], 
+                strict=False
+            )
         self.module.eval().requires_grad_(False)
         
-        self.model = self.module.diffusion_ema if (optimize_memory_use) else self.module.diffusion_ema.to(device_accelerator)
+        if precision == PrecisionType.INT8 and not use_quantized_cache:
+            quantize_unet(self.module.diffusion_ema)
+            
+            # the model folder may well be read-only, the cache is only a shortcut
+            try:
+                torch.save({'model_config': model_config, 'state_dict': self.module.state_dict()}, f"{quantized_path}.tmp")
+                os.replace(f"{quantized_path}.tmp", quantized_path)
+            except (OSError, RuntimeError) as error:
+                print(f"Could not write the int8 cache {quantized_path}, the model is quantized again on every load: {error}")
+        
+        self.attention = attention
+        self.attention_window = attention_window
+        self.attention_global_tokens = attention_global_tokens
+        for module in self.module.diffusion_ema.modules():
+            if isinstance(module, SelfAttention1d):
+                module.attention = attention
+                module.window_size = attention_window
+                module.global_tokens = attention_global_tokens
+        
+        self.precision = precision
+        apply_precision(self.module.diffusion_ema, precision, keep_fp32=(FourierFeatures,))
+        self.module.diffusion_ema.compute_dtype = precision.get_compute_dtype()
+        
+        self.use_compile = use_compile
+        model = CompiledModel(self.module.diffusion_ema) if (use_compile) else self.module.diffusion_ema
+        if use_compile:
+            # generation and tiled windows run whole chunks
+            model.plan(self.chunk_size)
+        
+        self.model = model if (optimize_memory_use) else model.to(device_accelerator)
+    
+    def get_cache_key(
+        self
+    ) -> tuple:
+        # every exact attention backend computes the same function, but not bit for bit
+        if self.attention == AttentionType.LOCAL:
+            return super().get_cache_key() + (self.attention.value, self.attention_window, self.attention_global_tokens)
+        return super().get_cache_key() + (self.attention.value,)
+    
+    def get_offload_units(
+        self
+    ) -> list[list[nn.Module]]:
+        """
+            The UNet in execution order, split at every level: the layers of each level
+            before its inner block, outermost first, then the layers after it,
+            innermost first.
+        """
+        down_units, up_units = [], []
+        
+        # the top level is a plain Sequential with the next level at index 3, every
+        # SkipBlock holds its inner level at index 7 of main, the innermost an Identity
+        layers, inner_index = list(self.module.diffusion_ema.net), 3
+        
+        while True:
+            down_units.append(layers[:inner_index])
+            up_units.append(layers[inner_index + 1:])
+            
+            inner = layers[inner_index]
+            if not isinstance(inner, SkipBlock):
+                break
+            layers, inner_index = list(inner.main), 7
+        
+        return down_units + up_units[::-1]
+    
+    def get_length_multiple(
+        self
+    ) -> int:
+        # every SkipBlock halves the length once on the way down
+        return 2 ** len(self.module.diffusion_ema.get_skip_blocks())
+    
+    def get_min_length(
+        self
+    ) -> int:
+        # the innermost level's cubic Upsample1d reflect pads 2 samples, which needs at least 3
+        return 3 * self.get_length_multiple()
+    
+    def get_sample_memory(
+        self,
+        length: int
+    ) -> int:
+        # the outermost UNet level keeps roughly a dozen fp32 activations of its width
+        # alive at full resolution, the skip inputs of the deeper levels add a few more
+        top_channels = self.module.diffusion_ema.net[0].main[0].out_channels
+        element_size = torch.finfo(self.precision.get_compute_dtype()).bits // 8
+        return element_size * length * top_channels * 16
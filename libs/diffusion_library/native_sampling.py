@@ -0,0 +1,174 @@
+import torch
+
+from tqdm.auto import trange
+from diffusion.utils import t_to_alpha_sigma
+
+# In-repo versions of the most used samplers from `diffusion.sampling` and
+# `k_diffusion.sampling`. They follow the same update rules in the same order,
+# but compute every per-step coefficient up front from the step list and update
+# the sampler state in preallocated buffers instead of allocating new tensors
+# for every intermediate. Tensors handed to `callback` are those live buffers,
+# copy them if they need to outlive the step.
+
+
+@torch.no_grad()
+def sample_ddim(model, x, steps, eta, extra_args, callback=None, noise_sampler=None):
+    ts = x.new_ones([x.shape[0]])
+    alphas, sigmas = t_to_alpha_sigma(steps)
+
+    ddim_sigmas = eta * (sigmas[1:]**2 / sigmas[:-1]**2).sqrt() * (1 - alphas[:-1]**2 / alphas[1:]**2).sqrt()
+    adjusted_sigmas = (sigmas[1:]**2 - ddim_sigmas**2).sqrt()
+
+    x = x.clone()
+    pred = torch.empty_like(x)
+    eps = torch.empty_like(x)
+
+    for i in trange(len(steps), disable=None):
+        v = model(x, ts * steps[i], **extra_args).float()
+
+        torch.mul(x, alphas[i], out=pred).addcmul_(v, -sigmas[i])
+        torch.mul(x, sigmas[i], out=eps).addcmul_(v, alphas[i])
+
+        if callback is not None:
+            callback({'x': x, 'i': i, 't': steps[i], 'v': v, 'pred': pred})
+
+        if i < len(steps) - 1:
+            torch.mul(pred, alphas[i + 1], out=x).addcmul_(eps, adjusted_sigmas[i])
+
+            if eta:
+                noise = noise_sampler(steps[i], steps[i + 1]) if noise_sampler is not None else torch.randn_like(x)
+                x.addcmul_(noise, ddim_sigmas[i])
+
+    return pred
+
+
+@torch.no_grad()
+def reverse_sample_ddim(model, x, steps, extra_args, callback=None):
+    ts = x.new_ones([x.shape[0]])
+    alphas, sigmas = t_to_alpha_sigma(steps)
+
+    x = x.clone()
+    pred = torch.empty_like(x)
+    eps = torch.empty_like(x)
+
+    for i in trange(len(steps) - 1, disable=None):
+        v = model(x, ts * steps[i], **extra_args).float()
+
+        torch.mul(x, alphas[i], out=pred).addcmul_(v, -sigmas[i])
+        torch.mul(x, sigmas[i], out=eps).addcmul_(v, alphas[i])
+
+        if callback is not None:
+            callback({'x': x, 'i': i, 't': steps[i], 'v': v, 'pred': pred})
+
+        torch.mul(pred, alphas[i + 1], out=x).addcmul_(eps, sigmas[i + 1])
+
+    return x
+
+
+# Adams-Bashforth weights for the current and up to three previous eps estimates
+_iplms_weights = [
+    [1.0],
+    [3 / 2, -1 / 2],
+    [23 / 12, -16 / 12, 5 / 12],
+    [55 / 24, -59 / 24, 37 / 24, -9 / 24],
+]
+
+
+@torch.no_grad()
+def iplms_sample(model, x, steps, extra_args, is_reverse=False, callback=None):
+    ts = x.new_ones([x.shape[0]])
+
+    if not is_reverse:
+        steps = torch.cat([steps, steps.new_zeros([1])])
+
+    alphas, sigmas = t_to_alpha_sigma(steps)
+
+    x = x.clone()
+    eps_cache = [torch.empty_like(x) for _ in range(4)]
+    eps_prime = torch.empty_like(x)
+    pred = torch.empty_like(x)
+
+    for i in trange(len(steps) - 1, disable=None):
+        v = model(x, ts * steps[i], **extra_args).float()
+
+        # ring buffer, slot i % 4 holds this step's eps and the older ones precede it
+        eps = eps_cache[i % 4]
+        torch.mul(x, sigmas[i], out=eps).addcmul_(v, alphas[i])
+
+        weights = _iplms_weights[min(i, 3)]
+        torch.mul(eps, weights[0], out=eps_prime)
+        for age, weight in enumerate(weights[1:], start=1):
+            eps_prime.add_(eps_cache[(i - age) % 4], alpha=weight)
+
+        if callback is not None:
+            torch.mul(eps, -sigmas[i], out=pred).add_(x).div_(alphas[i])
+
+        x.addcmul_(eps_prime, -sigmas[i]).div_(alphas[i])
+        x.mul_(alphas[i + 1]).addcmul_(eps_prime, sigmas[i + 1])
+
+        if callback is not None:
+            callback({'x': x, 'i': i, 't': steps[i], 'pred': pred})
+
+    return x
+
+
+@torch.no_grad()
+def sample_euler(model, x, sigmas, extra_args=None, callback=None, disable=None):
+    extra_args = {} if extra_args is None else extra_args
+    s_in = x.new_ones([x.shape[0]])
+
+    dts = sigmas[1:] - sigmas[:-1]
+
+    x = x.clone()
+    d = torch.empty_like(x)
+
+    for i in trange(len(sigmas) - 1, disable=disable):
+        denoised = model(x, sigmas[i] * s_in, **extra_args)
+
+        torch.sub(x, denoised, out=d).div_(sigmas[i])
+
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+
+        x.addcmul_(d, dts[i])
+
+    return x
+
+
+@torch.no_grad()
+def sample_dpmpp_2m(model, x, sigmas, extra_args=None, callback=None, disable=None):
+    extra_args = {} if extra_args is None else extra_args
+    s_in = x.new_ones([x.shape[0]])
+
+    # with t = -log(sigma): ratios[i] = sigma_fn(t_next) / sigma_fn(t), expm1s[i] = -(-h).expm1()
+    t = sigmas.log().neg()
+    h = t[1:] - t[:-1]
+    ratios = t[1:].neg().exp() / t[:-1].neg().exp()
+    expm1s = -(-h).expm1()
+
+    # second order correction with r = h_last / h, only from the second step on and never into sigma = 0
+    r = torch.ones_like(h)
+    r[1:] = (t[1:-1] - t[:-2]) / h[1:]
+    weights_current = 1 + 1 / (2 * r)
+    weights_old = -(1 / (2 * r))
+    use_second_order = [i > 0 and sigma_next != 0 for i, sigma_next in enumerate(sigmas[1:].tolist())]
+
+    x = x.clone()
+    denoised_d = torch.empty_like(x)
+    old_denoised = None
+
+    for i in trange(len(sigmas) - 1, disable=disable):
+        denoised = model(x, sigmas[i] * s_in, **extra_args)
+
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+
+        if use_second_order[i]:
+            torch.mul(denoised, weights_current[i], out=denoised_d).addcmul_(old_denoised, weights_old[i])
+            x.mul_(ratios[i]).addcmul_(denoised_d, expm1s[i])
+        else:
+            x.mul_(ratios[i]).addcmul_(denoised, expm1s[i])
+
+        old_denoised = denoised
+
+    return x
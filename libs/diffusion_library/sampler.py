@@ -1,6 +1,7 @@
 import enum, torch
 from diffusion import sampling as vsampling
 from k_diffusion import sampling as ksampling
+from libs.diffusion_library import native_sampling as nsampling
 
 
 class SamplerType(str, enum.Enum):
@@ -28,7 +29,70 @@ class SamplerType(str, enum.Enum):
     def is_v_sampler(cls, value):
         return value[0] == 'V'
 
+    def has_native_sample(self, **sampler_args) -> bool:
+        if not sampler_args.get('native', True):
+            return False
+        
+        if self == SamplerType.K_EULER:
+            # churn adds fresh noise every step, leave that to k-diffusion
+            return sampler_args.get('s_churn', 0.0) == 0.0
+        
+        return self in [SamplerType.V_DDIM, SamplerType.V_IPLMS, SamplerType.K_DPMPP2M]
+
+    def sample_native(self, model_fn, x_t, steps, callback, **sampler_args) -> torch.Tensor:
+        if self == SamplerType.V_DDIM:
+            if sampler_args.get('is_reverse'):
+                return nsampling.reverse_sample_ddim(
+                    model_fn,
+                    x_t,
+                    steps,
+                    sampler_args.get('extra_args', {}),
+                    callback
+                )
+            else:
+                return nsampling.sample_ddim(
+                    model_fn,
+                    x_t,
+                    steps,
+                    sampler_args.get('eta', 0.1),
+                    sampler_args.get('extra_args', {}),
+                    callback,
+                    sampler_args.get('noise_sampler', None)
+                )
+        elif self == SamplerType.V_IPLMS:
+            return nsampling.iplms_sample(
+                model_fn,
+                x_t,
+                steps,
+                sampler_args.get('extra_args', {}),
+                True,
+                callback
+            )
+        elif self == SamplerType.K_EULER:
+            return nsampling.sample_euler(
+                model_fn,
+                x_t,
+                steps,
+                sampler_args.get('extra_args', {}),
+                callback,
+                sampler_args.get('disable', False)
+            )
+        elif self == SamplerType.K_DPMPP2M:
+            return nsampling.sample_dpmpp_2m(
+                model_fn,
+                x_t,
+                steps,
+                sampler_args.get('extra_args', {}),
+                callback,
+                sampler_args.get('disable', False)
+            )
+        else:
+            raise Exception(f"No native sample implementation for sampler_type '{self}'")
+
     def sample(self, model_fn, x_t, steps, callback, **sampler_args) -> torch.Tensor:
+        if self.has_native_sample(**sampler_args):
+            return self.sample_native(model_fn, x_t, steps, callback, **sampler_args)
+        
         if self == SamplerType.V_DDPM:
             if sampler_args.get('is_reverse'):
                 return vsampling.reverse_sample(
@@ -0,0 +1,93 @@
+import os, sys
+import argparse
+import resource
+import time
+import torch
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from libs.dance_diffusion.dd.blocks import SelfAttention1d
+from libs.dance_diffusion.base.type import AttentionType
+
+# Compares the SelfAttention1d backends on CPU at the sequence lengths the attention
+# levels of the UNet see for a range of chunk sizes. Every measurement runs in its
+# own process so that its peak RSS is not hidden by an earlier, larger run. The
+# approximate 'local' backend is compared by its error against the exact result.
+#
+# Defaults on one CPU core with torch 2.14, ms per call and peak RSS growth in MB (the
+# smallest rows are mostly allocator noise). Every exact backend matches 'math', and
+# 'local' only approximates past 4 windows (seq len 2048 here):
+#
+#   chunk size  seq len   math ms/MB       sdpa ms/MB       chunked ms/MB    local ms/MB
+#        65536      256     14 /   26       17 /   24       16 /   20       20 /   20
+#       131072      512     48 /   66       71 /   56       51 /   50       39 /   64
+#       262144     1024    176 /  159      238 /  171      146 /  149      170 /  157
+#       524288     2048    659 /  562      976 /  621      619 /  304      591 /  300
+#      1048576     4096   2409 / 2149     3684 / 2393     2227 /  566     1660 /  917  (rel err 0.25)
+
+
+def measure(backend, channels, n_heads, seq_len, query_chunk_size, window_size, global_tokens, repeats, seed):
+    torch.manual_seed(seed)
+    block = SelfAttention1d(channels, n_heads).eval().requires_grad_(False)
+    block.attention = AttentionType(backend)
+    block.query_chunk_size = query_chunk_size
+    block.window_size = window_size
+    block.global_tokens = global_tokens
+    x = torch.randn([1, channels, seq_len])
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with torch.no_grad():
+        output = block(x)
+
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            block(x)
+        step_ms = (time.perf_counter() - start_time) / repeats * 1000
+
+    # ru_maxrss is in kilobytes on linux
+    peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024
+
+    # without the residual input, which is the same for every backend
+    return step_ms, peak_mb, output - x
+
+
+def main(args):
+    context = mp.get_context('spawn')
+
+    print(f"{'chunk size':>12}{'seq len':>10}{'backend':>10}{'ms':>12}{'peak MB':>12}{'max err':>12}{'rel err':>12}")
+
+    for chunk_size in args.chunk_sizes:
+        # the attention levels start at depth - n_attn_layers - 1, each level halves the length
+        seq_len = chunk_size // 2**(args.depth - args.n_attn_layers - 2)
+        reference = None
+
+        for backend in [AttentionType.MATH, AttentionType.SDPA, AttentionType.CHUNKED, AttentionType.LOCAL]:
+            with context.Pool(1) as pool:
+                step_ms, peak_mb, output = pool.apply(
+                    measure,
+                    (backend.value, args.channels, args.channels // 32, seq_len, args.query_chunk_size, args.window_size, args.global_tokens, args.repeats, args.seed)
+                )
+
+            reference = output if reference is None else reference
+            max_error = (output - reference).abs().max().item()
+            relative_error = ((output - reference).norm() / reference.norm()).item()
+
+            print(f"{chunk_size:>12}{seq_len:>10}{backend.value:>10}{step_ms:>12.2f}{peak_mb:>12.1f}{max_error:>12.2e}{relative_error:>12.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark SelfAttention1d backends on CPU across chunk sizes.")
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[65536, 131072, 262144, 524288, 1048576])
+    parser.add_argument('--channels', type=int, default=512)
+    parser.add_argument('--depth', type=int, default=14)
+    parser.add_argument('--n-attn-layers', type=int, default=4)
+    parser.add_argument('--query-chunk-size', type=int, default=1024)
+    parser.add_argument('--window-size', type=int, default=512)
+    parser.add_argument('--global-tokens', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,107 @@
+import os, sys
+import argparse
+import time
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from k_diffusion.external import VDenoiser
+
+from libs.diffusion_library.sampler import SamplerType
+from libs.diffusion_library.scheduler import SchedulerType
+from libs.util.util import FeatureCaching
+from libs.scripts.benchmark_unet import load_unet
+
+# Samples the same noise with and without deep feature caching for several samplers,
+# cached levels and refresh intervals, and reports the speedup against the spectral
+# distance (mean absolute log-magnitude STFT difference) to the uncached result.
+#
+# Random weights, length 32768, 20 steps, one CPU core, speedup / spectral distance.
+# Only caching 12 of the 13 levels pays off at this length, the deepest levels are
+# short. Random weights understate the distance a trained model would show, which is
+# why caching stays off unless asked for, with 3 as the faster refresh interval:
+#
+#   levels interval   V_DDIM          V_IPLMS         K_EULER         K_DPMPP2M
+#        4        2   0.98x 0.0000    1.02x 0.0000    0.97x 0.0000    1.00x 0.0000
+#        4        3   0.97x 0.0000    1.01x 0.0000    0.98x 0.0000    1.04x 0.0000
+#        8        2   1.08x 0.0002    1.03x 0.0006    1.06x 0.0002    1.24x 0.0027
+#        8        3   1.13x 0.0004    1.08x 0.0018    1.14x 0.0002    1.16x 0.0038
+#       12        2   1.47x 0.0018    1.49x 0.0032    1.53x 0.0032    1.51x 0.0143
+#       12        3   1.77x 0.0036    1.79x 0.0052    1.79x 0.0032    1.97x 0.0217
+
+
+def spectral_distance(a, b, n_fft=2048, hop_length=512, eps=1e-5):
+    window = torch.hann_window(n_fft, device=a.device)
+    stft = lambda x: torch.stft(x.flatten(0, 1), n_fft, hop_length, window=window, return_complex=True).abs()
+    return ((stft(a) + eps).log() - (stft(b) + eps).log()).abs().mean().item()
+
+
+def sample(unet, sampler, x_T, step_list, levels, interval, device, seed):
+    if SamplerType.is_v_sampler(sampler):
+        model = unet
+    else:
+        model = VDenoiser(unet)
+        x_T = x_T * step_list[0]
+
+    if levels > 0:
+        model = FeatureCaching(model, unet.get_skip_blocks()[-levels], interval)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+    # eta and ancestral samplers draw fresh noise, the same for every run
+    torch.manual_seed(seed)
+    start_time = time.perf_counter()
+
+    with torch.no_grad():
+        result = sampler.sample(model, x_T, step_list, None)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+    if isinstance(model, FeatureCaching):
+        model.remove()
+
+    return (time.perf_counter() - start_time) * 1000, result.float()
+
+
+def main(args):
+    device = torch.device(args.device)
+    unet = load_unet(args.model, args.n_attn_layers).to(device)
+
+    torch.manual_seed(args.seed)
+    x_T = torch.randn([args.batch_size, 2, args.length], device=device)
+
+    print(f"{'sampler':<14}{'levels':>8}{'interval':>10}{'ms':>12}{'speedup':>10}{'spec dist':>12}")
+
+    for sampler in [SamplerType[name] for name in args.samplers.split(',')]:
+        if SamplerType.is_v_sampler(sampler):
+            step_list = SchedulerType.V_CRASH.get_step_list(args.steps, device.type)
+        else:
+            step_list = SchedulerType.K_KARRAS.get_step_list(args.steps, device.type, sigma_min=0.1, sigma_max=50.0, rho=0.7)
+
+        baseline_ms, baseline = sample(unet, sampler, x_T, step_list, 0, 1, device, args.seed)
+        print(f"{sampler.value:<14}{0:>8}{'-':>10}{baseline_ms:>12.0f}{1.0:>9.2f}x{0.0:>12.4f}")
+
+        for levels in [int(value) for value in args.levels.split(',')]:
+            for interval in [int(value) for value in args.intervals.split(',')]:
+                step_ms, result = sample(unet, sampler, x_T, step_list, levels, interval, device, args.seed)
+                distance = spectral_distance(result, baseline)
+                print(f"{sampler.value:<14}{levels:>8}{interval:>10}{step_ms:>12.0f}{baseline_ms / step_ms:>9.2f}x{distance:>12.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark deep feature caching across samplers.")
+    parser.add_argument('--model', default=None, help="checkpoint to load, random weights if omitted")
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--length', type=int, default=65536)
+    parser.add_argument('--n-attn-layers', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--samplers', default='V_DDIM,V_IPLMS,K_EULER,K_DPMPP2M')
+    parser.add_argument('--levels', default='4,8,12', help="comma separated numbers of deepest levels to cache")
+    parser.add_argument('--intervals', default='2,3,5', help="comma separated full refresh intervals")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,143 @@
+import os, sys
+import argparse
+import time
+import copy
+import types
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from libs.dance_diffusion.dd.ddattnunet import DiffusionAttnUnet1D
+from libs.dance_diffusion.dd.compiled import CompiledModel
+from libs.dance_diffusion.dd.blocks import FourierFeatures
+from libs.dance_diffusion.base.type import PrecisionType
+from libs.dance_diffusion.base.precision import apply_precision
+from libs.dance_diffusion.dd.model import quantize_unet, DDModelWrapper
+from libs.dance_diffusion.base.offload import BlockwiseOffloader
+
+# Times one UNet evaluation (one sampler step) for each model variant and compares
+# its output against the eager fp32 model. On CUDA it also reports the peak memory
+# allocated during the timed steps.
+
+
+def load_unet(model_path, n_attn_layers):
+    model = DiffusionAttnUnet1D(global_args={'latent_dim': 0}, n_attn_layers=n_attn_layers)
+
+    if model_path != None:
+        state_dict = torch.load(model_path, map_location='cpu')['state_dict']
+        prefix = 'diffusion_ema.'
+        model.load_state_dict({k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)})
+
+    return model.eval().requires_grad_(False)
+
+
+def build_variants(model, device, args):
+    # eager always runs, as the baseline
+    wanted = lambda name: args.variants == None or name in args.variants.split(',')
+    variants = {
+        'eager': model,
+    }
+    offloader = None
+    
+    if wanted('concat'):
+        concat = copy.deepcopy(model)
+        concat.fold_timestep_embed = False
+        variants['concat'] = concat
+
+    if wanted('compiled'):
+        compiled = CompiledModel(model)
+        start_time = time.perf_counter()
+        compiled.warmup(args.batch_size, args.length, device=device)
+        print(f"compiled in {time.perf_counter() - start_time:.0f} s")
+        variants['compiled'] = compiled
+
+    for precision in [PrecisionType.BF16, PrecisionType.FP16_STORAGE]:
+        if wanted(precision.value):
+            variant = apply_precision(copy.deepcopy(model), precision, keep_fp32=(FourierFeatures,))
+            variant.compute_dtype = precision.get_compute_dtype()
+            variants[precision.value] = variant
+
+    if device.type == 'cpu' and wanted(PrecisionType.INT8.value):
+        variants[PrecisionType.INT8.value] = quantize_unet(copy.deepcopy(model))
+
+    if wanted('blockwise'):
+        # weights live on the CPU and stream to `device` level by level, CPU to CPU this still copies
+        wrapper = DDModelWrapper()
+        wrapper.module = types.SimpleNamespace(diffusion_ema=copy.deepcopy(model).cpu())
+        memory_budget = args.offload_budget_mb * 1024 * 1024 if args.offload_budget_mb > 0 else None
+        offloader = BlockwiseOffloader(wrapper.module.diffusion_ema, wrapper.get_offload_units(), device, memory_budget=memory_budget)
+        variants['blockwise'] = wrapper.module.diffusion_ema
+
+    return variants, offloader
+
+
+def time_step(model, x, t, repeats, device):
+    with torch.no_grad():
+        output = model(x, t)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(device)
+
+        start_time = time.perf_counter()
+
+        for _ in range(repeats):
+            model(x, t)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    step_ms = (time.perf_counter() - start_time) / repeats * 1000
+    # steady state peak, after the first call
+    peak_mb = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else None
+
+    return step_ms, peak_mb, output.float()
+
+
+def main(args):
+    device = torch.device(args.device)
+    model = load_unet(args.model, args.n_attn_layers).to(device)
+
+    torch.manual_seed(args.seed)
+    x = torch.randn([args.batch_size, 2, args.length], device=device)
+    t = torch.full([args.batch_size], 0.5, device=device)
+
+    results = []
+    baseline_ms, baseline = None, None
+
+    variants, offloader = build_variants(model, device, args)
+
+    for name, variant in variants.items():
+        step_ms, peak_mb, output = time_step(variant, x, t, args.repeats, device)
+
+        if baseline == None:
+            baseline_ms, baseline = step_ms, output
+
+        max_error = (output - baseline).abs().max().item()
+        relative_error = ((output - baseline).norm() / baseline.norm()).item()
+        results.append((name, step_ms, baseline_ms / step_ms, max_error, relative_error, peak_mb))
+
+    print(f"{'variant':<16}{'ms/step':>12}{'speedup':>10}{'max err':>12}{'rel err':>12}{'peak MB':>10}")
+    for name, step_ms, speedup, max_error, relative_error, peak_mb in results:
+        peak = f"{peak_mb:>10.1f}" if peak_mb != None else f"{'-':>10}"
+        print(f"{name:<16}{step_ms:>12.2f}{speedup:>9.2f}x{max_error:>12.2e}{relative_error:>12.2e}{peak}")
+
+    if offloader != None:
+        weight_bytes = sum(tensor.numel() * tensor.element_size() for tensor in model.parameters())
+        print(f"\nblockwise peak resident weights: {offloader.peak_resident_bytes / 2**20:.1f} MB of {weight_bytes / 2**20:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark DiffusionAttnUnet1D variants per sampler step.")
+    parser.add_argument('--model', default=None, help="checkpoint to load, random weights if omitted")
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--length', type=int, default=65536)
+    parser.add_argument('--n-attn-layers', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--variants', default=None, help="comma separated variants to run besides eager, all if omitted")
+    parser.add_argument('--offload-budget-mb', type=int, default=0, help="weight memory budget of the blockwise variant, 0 for no limit")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,162 @@
+import os, sys
+import argparse
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from k_diffusion.external import VDenoiser
+from diffusion import sampling as vsampling
+
+from libs.diffusion_library.sampler import SamplerType
+from libs.diffusion_library.scheduler import SchedulerType
+from libs.dance_diffusion.dd.blocks import Downsample1d, Upsample1d, _kernels
+from libs.dance_diffusion.dd.ddattnunet import DiffusionAttnUnet1D
+from libs.dance_diffusion.dd.model import DDModelWrapper, DanceDiffusionInference
+from libs.dance_diffusion.dd.inference import DDInference
+
+# Checks that the optimized code paths compute the same function as the code they
+# replace, on CPU with random inputs. Prints the max absolute error of every check
+# and exits with an error if any is above its tolerance.
+
+
+class ToyDenoiser(nn.Module):
+    # smooth and nonlinear in both x and t, like a v-prediction network
+    def __init__(self, seed):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.weight = nn.Parameter(torch.randn([2, 2], generator=generator) * 0.5)
+
+    def forward(self, x, t):
+        return torch.tanh(torch.einsum('oc,ncs->nos', self.weight, x)) * t[:, None, None].cos() + x * t[:, None, None].sin() * 0.5
+
+
+def check_native_samplers(args):
+    model = ToyDenoiser(args.seed)
+    x = torch.randn([2, 2, 4096], generator=torch.Generator().manual_seed(args.seed))
+
+    cases = [
+        (SamplerType.V_DDIM, SchedulerType.V_CRASH, {'eta': 0.0}),
+        (SamplerType.V_DDIM, SchedulerType.V_CRASH, {'eta': 0.5}),
+        (SamplerType.V_DDIM, SchedulerType.V_CRASH, {'eta': 0.0, 'is_reverse': True}),
+        (SamplerType.V_IPLMS, SchedulerType.V_CRASH, {}),
+        (SamplerType.K_EULER, SchedulerType.K_KARRAS, {}),
+        (SamplerType.K_DPMPP2M, SchedulerType.K_KARRAS, {}),
+    ]
+
+    results = []
+    for sampler, scheduler, sampler_args in cases:
+        steps = scheduler.get_step_list(args.steps, 'cpu', sigma_min=0.1, sigma_max=50.0, rho=0.7)
+
+        if sampler_args.get('is_reverse'):
+            steps = steps.flip(0)
+
+        if SamplerType.is_v_sampler(sampler):
+            model_fn, x_t = model, x
+        else:
+            model_fn, x_t = VDenoiser(model), x * steps[0]
+
+        with torch.no_grad():
+            # both draw the same fresh noise in the same order when eta > 0
+            torch.manual_seed(args.seed)
+            native = sampler.sample(model_fn, x_t, steps, None, native=True, **sampler_args)
+
+            torch.manual_seed(args.seed)
+            if sampler_args.get('is_reverse'):
+                # the library fallback in SamplerType passes an eta that reverse_sample does not take
+                library = vsampling.reverse_sample(model_fn, x_t, steps, {})
+            else:
+                library = sampler.sample(model_fn, x_t, steps, None, native=False, **sampler_args)
+
+        name = f"native {sampler.value} " + ' '.join(f"{key}={value}" for key, value in sampler_args.items())
+        results.append((name, (native - library).abs().max().item(), library.abs().max().item()))
+
+    return results
+
+
+def get_dense_weight(module, x):
+    # the [C, C, K] weight both layers built on every call before they went depthwise
+    weight = x.new_zeros([x.shape[1], x.shape[1], module.kernel.shape[0]])
+    indices = torch.arange(x.shape[1], device=x.device)
+    weight[indices, indices] = module.kernel.to(weight)
+    return weight
+
+
+def check_resampling(args):
+    x = torch.randn([2, 64, 4096], generator=torch.Generator().manual_seed(args.seed))
+
+    results = []
+    for kernel in _kernels:
+        down, up = Downsample1d(kernel), Upsample1d(kernel)
+
+        with torch.no_grad():
+            x_down = F.pad(x, (down.pad,) * 2, down.pad_mode)
+            dense = F.conv1d(x_down, get_dense_weight(down, x), stride=2)
+            results.append((f"depthwise Downsample1d {kernel}", (down(x) - dense).abs().max().item(), dense.abs().max().item()))
+
+            x_up = F.pad(x, ((up.pad + 1) // 2,) * 2, up.pad_mode)
+            dense = F.conv_transpose1d(x_up, get_dense_weight(up, x), stride=2, padding=up.pad * 2 + 1)
+            results.append((f"depthwise Upsample1d {kernel}", (up(x) - dense).abs().max().item(), dense.abs().max().item()))
+
+    return results
+
+
+def check_timestep_fold(args):
+    torch.manual_seed(args.seed)
+    unet = DiffusionAttnUnet1D(global_args={'latent_dim': 0}, n_attn_layers=4).eval().requires_grad_(False)
+
+    # the shortest input every level of the UNet can pad
+    x = torch.randn([2, 2, 24576])
+    t = torch.rand([2])
+
+    with torch.no_grad():
+        folded = unet(x, t)
+        unet.fold_timestep_embed = False
+        concat = unet(x, t)
+
+    return [("folded timestep embedding", (folded - concat).abs().max().item(), concat.abs().max().item())]
+
+
+def check_planned_length(args):
+    torch.manual_seed(args.seed)
+    wrapper = DDModelWrapper()
+    wrapper.module = DanceDiffusionInference(n_attn_layers=4, latent_dim=0).eval().requires_grad_(False)
+    inference = DDInference(torch.device('cpu'), torch.device('cpu'), model=wrapper)
+
+    # the shortest clip is planned to the shortest length the UNet runs at, not just the next multiple
+    length = inference.plan_length(1)
+    x = torch.randn([2, 2, length])
+    t = torch.rand([2])
+
+    with torch.no_grad():
+        output = wrapper.module.diffusion_ema(x, t)
+
+    # nothing to compare against, it only has to run and stay finite
+    max_error = 0.0 if output.shape == x.shape and output.isfinite().all() else float('inf')
+    return [(f"shortest planned length {length}", max_error, output.abs().max().item())]
+
+
+def main(args):
+    results = []
+    for check in [check_native_samplers, check_resampling, check_timestep_fold, check_planned_length]:
+        results += check(args)
+
+    failed = False
+    print(f"{'check':<44}{'max err':>12}{'max abs':>12}")
+    for name, max_error, max_abs in results:
+        ok = max_error <= args.tolerance * max(max_abs, 1.0)
+        failed = failed or not ok
+        print(f"{name:<44}{max_error:>12.2e}{max_abs:>12.2e}  {'ok' if ok else 'FAILED'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check optimized code paths against the code they replace.")
+    parser.add_argument('--steps', type=int, default=25)
+    parser.add_argument('--tolerance', type=float, default=1e-4, help="relative to the largest output value")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,133 @@
+import os, sys
+import argparse
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from libs.dance_diffusion.api import InferenceQueue, Request, RequestType, Response
+from libs.dance_diffusion.base.type import ModelType
+
+# Checks that InferenceQueue resolves every future and keeps serving after requests
+# that fail while being grouped, merged or run, and that merged requests only see
+# their own items in sampler callbacks, with a stand-in handler that returns each
+# item's seed instead of sampling.
+
+
+class SeedHandler:
+    def process_request(self, request, callback=None):
+        if request.kwargs.get('fail'):
+            raise RuntimeError("failing on purpose")
+        seeds = request.kwargs.get('sample_seeds') or [request.kwargs['seed'] + index for index in range(request.kwargs['batch_size'])]
+        
+        # one sampler call per item, like micro-batches of one
+        if callback != None:
+            for start, seed in enumerate(seeds):
+                callback({'i': 0, 'x': torch.tensor([[seed]]), 'batch_start': start, 'progress': start + 1, 'progress_max': len(seeds)})
+        
+        return Response(torch.tensor(seeds)[:, None], 0, [0] * len(seeds))
+
+
+def make_request(request_type, seed, batch_size=1, **kwargs):
+    if seed != None:
+        kwargs.update(seed=seed)
+    return Request(
+        request_type,
+        'model.ckpt',
+        ModelType.DD,
+        65536,
+        44100,
+        batch_size=batch_size,
+        scheduler_args={},
+        sampler_args={},
+        **kwargs
+    )
+
+
+def check_failures(args):
+    inference_queue = InferenceQueue(SeedHandler(), batch_window=args.batch_window)
+    audio_source = torch.zeros([2, 8])
+
+    cases = [
+        # no source to key the merge on
+        ("merge key fails", make_request(RequestType.Variation, 0, audio_source=None)),
+        # mergeable with the request before it, but without a seed to merge
+        ("merge fails", make_request(RequestType.Variation, None, audio_source=audio_source, noise_level=0.5)),
+        ("run fails", make_request(RequestType.Generation, 2, fail=True)),
+    ]
+
+    results = []
+    for name, request in cases:
+        futures = [
+            inference_queue.submit(make_request(RequestType.Variation, 10, audio_source=audio_source, noise_level=0.5)),
+            inference_queue.submit(request),
+            inference_queue.submit(make_request(RequestType.Generation, 20, batch_size=2)),
+        ]
+
+        try:
+            failed = futures[1].exception(timeout=args.timeout) != None
+            served = futures[0].result(timeout=args.timeout).result.flatten().tolist() == [10] and futures[2].result(timeout=args.timeout).result.flatten().tolist() == [20, 21]
+        except Exception as error:
+            failed, served = False, False
+            print(f"{name}: {type(error).__name__} {error}")
+
+        # the next request after the failure still runs
+        try:
+            served = served and inference_queue.submit(make_request(RequestType.Generation, 30)).result(timeout=args.timeout).result.item() == 30
+        except Exception:
+            served = False
+
+        results.append((name, failed and served))
+
+    inference_queue.shutdown()
+    return results
+
+
+def check_callbacks(args):
+    inference_queue = InferenceQueue(SeedHandler(), batch_window=args.batch_window)
+    
+    seen = [[], [], []]
+    progress = [[], [], []]
+    
+    def make_callback(index):
+        def callback(info):
+            if 'x' in info:
+                seen[index] += info['x'].flatten().tolist()
+            progress[index].append(info['progress'])
+        return callback
+    
+    futures = [
+        inference_queue.submit(make_request(RequestType.Generation, seed, batch_size), make_callback(index))
+        for index, (seed, batch_size) in enumerate([(0, 2), (10, 1), (20, 3)])
+    ]
+    
+    try:
+        for future in futures:
+            future.result(timeout=args.timeout)
+    except Exception as error:
+        print(f"callbacks: {type(error).__name__} {error}")
+        return [("callbacks", False)]
+    
+    inference_queue.shutdown()
+    return [
+        ("callbacks see own items", seen == [[0, 1], [10], [20, 21, 22]]),
+        # every sampler call still reports progress to every job
+        ("callbacks get progress", all(values == [1, 2, 3, 4, 5, 6] for values in progress)),
+    ]
+
+
+def main(args):
+    results = check_failures(args) + check_callbacks(args)
+
+    for name, ok in results:
+        print(f"{name:<24}{'ok' if ok else 'FAILED'}")
+
+    sys.exit(0 if all(ok for _, ok in results) else 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that InferenceQueue survives failing requests.")
+    parser.add_argument('--batch-window', type=float, default=0.1)
+    parser.add_argument('--timeout', type=float, default=10.0)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,193 @@
+import os
+import hashlib
+import threading
+import torch
+
+from collections import OrderedDict
+
+
+def hash_tensor(tensor: torch.Tensor) -> str:
+    m = hashlib.sha256()
+    data = tensor.detach().to('cpu', torch.float32).contiguous()
+    m.update(str(tuple(data.shape)).encode())
+    m.update(data.numpy().tobytes())
+    return m.hexdigest()
+
+
+def hash_key(*parts) -> str:
+    m = hashlib.sha256()
+    for part in parts:
+        m.update(repr(part).encode())
+        m.update(b'\0')
+    return m.hexdigest()
+
+
+class TensorCache():
+    """
+        In-memory LRU cache of tensors keyed by a hash string. Entries are kept on
+        the CPU; when `spill_path` is set, entries evicted from memory are written
+        there and read back on their next hit instead of being recomputed. The
+        spilled files are themselves an LRU cache bounded to `max_spill_bytes`.
+    """
+    def __init__(
+        self,
+        max_entries: int = 16,
+        spill_path: str = None,
+        max_spill_bytes: int = 1024**3
+    ):
+        self.max_entries = max_entries
+        self.spill_path = spill_path
+        self.entries: OrderedDict[str, torch.Tensor] = OrderedDict()
+        
+        self.hits = 0
+        self.misses = 0
+        
+        self.spill = ResultCache(spill_path, max_spill_bytes) if spill_path != None else None
+    
+    def get(
+        self,
+        key: str,
+        device: torch.device = None
+    ) -> torch.Tensor:
+        if key not in self.entries:
+            spilled = self.spill.get(key) if self.spill != None else None
+            
+            if spilled is None:
+                self.misses += 1
+                return None
+            
+            # copied into memory, so the memory-mapped file is not held open
+            self.put(key, spilled)
+        
+        self.entries.move_to_end(key)
+        tensor = self.entries[key]
+        
+        self.hits += 1
+        return tensor.to(device) if device != None else tensor.clone()
+    
+    def put(
+        self,
+        key: str,
+        tensor: torch.Tensor
+    ):
+        self.entries[key] = tensor.detach().to('cpu', copy=True)
+        self.entries.move_to_end(key)
+        
+        while len(self.entries) > self.max_entries:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            
+            if self.spill != None and evicted_key not in self.spill.entries:
+                self.spill.put(evicted_key, evicted)
+    
+    def clear(self):
+        self.entries.clear()
+    
+    def __len__(self):
+        return len(self.entries)
+
+
+# sha256 of model files, keyed on (path, size, mtime) so an unchanged file is only read once
+_file_hashes = {}
+
+def hash_file(path: str) -> str:
+    stat = os.stat(path)
+    file_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    
+    if file_key not in _file_hashes:
+        m = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                m.update(block)
+        _file_hashes[file_key] = m.hexdigest()
+    
+    return _file_hashes[file_key]
+
+
+class ResultCache():
+    """
+        On-disk LRU cache of result tensors keyed by a hash string, bounded to
+        `max_bytes` of files in `path`. It survives restarts: the recency order is
+        rebuilt from the file modification times, which every hit refreshes. Hits
+        are loaded memory-mapped where torch supports it, except on Windows, which
+        cannot remove or replace a file while it is mapped.
+    """
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 2 * 1024**3
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        
+        os.makedirs(self.path, exist_ok=True)
+        
+        files = [entry for entry in os.scandir(self.path) if entry.is_file() and entry.name.endswith('.pt')]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            self.entries[entry.name[:-3]] = entry.stat().st_size
+            self.total_bytes += entry.stat().st_size
+        
+        self.evict()
+    
+    def get_file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.pt")
+    
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            if os.path.isfile(self.get_file(key)):
+                os.remove(self.get_file(key))
+    
+    def get(
+        self,
+        key: str
+    ) -> torch.Tensor:
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            
+            file = self.get_file(key)
+            
+            try:
+                try:
+                    tensor = torch.load(file, map_location='cpu', mmap=os.name != 'nt')
+                except TypeError:
+                    # torch before 2.1 cannot memory-map
+                    tensor = torch.load(file, map_location='cpu')
+            except (OSError, RuntimeError):
+                self.total_bytes -= self.entries.pop(key)
+                self.misses += 1
+                return None
+            
+            os.utime(file)
+            self.entries.move_to_end(key)
+            self.hits += 1
+            
+            return tensor
+    
+    def put(
+        self,
+        key: str,
+        tensor: torch.Tensor
+    ):
+        file = self.get_file(key)
+        
+        with self.lock:
+            # clone so that a view only stores its own elements, then swap the file in atomically
+            torch.save(tensor.detach().to('cpu').clone(), f"{file}.tmp")
+            os.replace(f"{file}.tmp", file)
+            
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]
+            self.entries[key] = os.path.getsize(file)
+            self.entries.move_to_end(key)
+            self.total_bytes += self.entries[key]
+            
+            self.evict()
@@ -2,21 +2,37 @@ import os
 import torch
 import torchaudio
 from k_diffusion.utils import append_dims
+from diffusion.utils import t_to_alpha_sigma
 
 
-def tensor_slerp_2D(a: torch.Tensor, b: torch.Tensor, t: float):
-    slerped = torch.empty_like(a)
+def tensor_slerp_batch(a: torch.Tensor, b: torch.Tensor, t, eps: float = 1e-6) -> torch.Tensor:
+    """
+        Spherical interpolation between `a` and `b` along their last dimension, for
+        every position in `t` at once: returns `[len(t), *a.shape]`. Where the angle
+        between `a` and `b` is too small for sin(omega) to be divided by, it falls back
+        to linear interpolation, which slerp approaches there anyway.
+    """
+    t = torch.as_tensor(t, dtype=a.dtype, device=a.device).reshape(-1, *([1] * a.ndim))
+    
+    dot = (a / torch.linalg.norm(a, dim=-1, keepdim=True) * b / torch.linalg.norm(b, dim=-1, keepdim=True)).sum(-1, keepdim=True)
+    omega = torch.arccos(dot.clamp(-1.0, 1.0))
+    so = torch.sin(omega)
+    
+    is_safe = so.abs() > eps
+    so = torch.where(is_safe, so, torch.ones_like(so))
     
-    for channel in range(a.size(0)):
-        slerped[channel] = tensor_slerp(a[channel], b[channel], t)
+    weight_a = torch.where(is_safe, torch.sin((1.0 - t) * omega) / so, 1.0 - t)
+    weight_b = torch.where(is_safe, torch.sin(t * omega) / so, t)
     
-    return slerped
+    return weight_a * a + weight_b * b
+
+
+def tensor_slerp_2D(a: torch.Tensor, b: torch.Tensor, t: float):
+    return tensor_slerp_batch(a, b, [t])[0]
 
 
 def tensor_slerp(a: torch.Tensor, b: torch.Tensor, t: float):
-    omega = torch.arccos(torch.dot(a / torch.linalg.norm(a), b / torch.linalg.norm(b)))
-    so = torch.sin(omega)
-    return torch.sin((1.0 - t) * omega) / so * a + torch.sin(t * omega) / so * b
+    return tensor_slerp_batch(a, b, [t])[0]
 
 
 def load_audio(device, audio_path: str, sample_rate):
@@ -62,6 +78,214 @@ def crop_audio(source: torch.Tensor, chunk_size: int, crop_offset: int = 0) -> t
     return chunk
 
 
+class TiledSampling(torch.nn.Module):
+    """
+        Denoises a latent longer than the model's chunk size by splitting it into
+        overlapping windows of `chunk_size` samples. All windows go through the
+        model as one batch and the overlaps are crossfaded back together, so the
+        windows agree with each other at every sampler step.
+    """
+    def __init__(self, model, chunk_size: int, overlap: int):
+        super().__init__()
+        assert 0 <= overlap <= chunk_size // 2, "overlap must be at most half the chunk size"
+        self.model = model
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.stride = chunk_size - overlap
+    
+    @staticmethod
+    def get_latent_length(length: int, chunk_size: int, overlap: int) -> int:
+        stride = chunk_size - overlap
+        n_windows = 1 + max(0, -(-(length - chunk_size) // stride))
+        return chunk_size + (n_windows - 1) * stride
+    
+    def get_window_weights(self, n_windows: int, reference: torch.Tensor) -> torch.Tensor:
+        weights = reference.new_ones([n_windows, self.chunk_size])
+        
+        if self.overlap > 0:
+            fade_in = (torch.arange(self.overlap, device=reference.device, dtype=reference.dtype) + 0.5) / self.overlap
+            weights[1:, :self.overlap] = fade_in
+            weights[:-1, -self.overlap:] = fade_in.flip(0)
+        
+        return weights
+    
+    def forward(self, input, t, **kwargs):
+        batch_size, n_channels, length = input.shape
+        
+        windows = input.unfold(2, self.chunk_size, self.stride)
+        n_windows = windows.shape[2]
+        windows = windows.permute(0, 2, 1, 3).reshape(batch_size * n_windows, n_channels, self.chunk_size)
+        
+        out = self.model(windows, t.repeat_interleave(n_windows), **kwargs)
+        out = out.view(batch_size, n_windows, n_channels, self.chunk_size)
+        out = out * self.get_window_weights(n_windows, out)[None, :, None, :]
+        
+        result = out.new_zeros([batch_size, n_channels, length])
+        for window in range(n_windows):
+            offset = window * self.stride
+            result[:, :, offset:offset + self.chunk_size] += out[:, window]
+        
+        return result
+
+
+class EarlyStopping(torch.nn.Module):
+    """
+        Wraps a denoiser and stops evaluating it for batch items whose denoised
+        estimate has changed by less than `threshold` (relative L2) for `patience`
+        consecutive calls. Only the remaining items are passed to the model, the
+        finished ones are answered from their last estimate, so the sampler keeps
+        stepping them towards it for free.
+        
+        With `v_parameterization` the model returns v and takes t, otherwise it
+        returns the denoised estimate and takes sigma.
+    """
+    def __init__(self, model, threshold: float, patience: int = 3, v_parameterization: bool = False):
+        super().__init__()
+        self.model = model
+        self.threshold = threshold
+        self.patience = patience
+        self.v_parameterization = v_parameterization
+        
+        self.active = None
+        self.stable_steps = None
+        self.previous = None
+        self.steps_skipped = 0
+        self.item_steps_skipped = None
+    
+    def get_denoised(self, input, output, t):
+        if not self.v_parameterization:
+            return output
+        alpha, sigma = t_to_alpha_sigma(append_dims(t, input.ndim))
+        return input * alpha - output * sigma
+    
+    def get_output(self, input, denoised, t):
+        if not self.v_parameterization:
+            return denoised
+        alpha, sigma = t_to_alpha_sigma(append_dims(t, input.ndim))
+        # at sigma = 0 the estimate is the input itself whatever v is
+        return torch.where(sigma > 0, (input * alpha - denoised) / sigma.clamp(min=1e-8), torch.zeros_like(input))
+    
+    def forward(self, input, t, **kwargs):
+        if self.active is None:
+            self.active = torch.ones([input.shape[0]], dtype=torch.bool, device=input.device)
+            self.stable_steps = torch.zeros([input.shape[0]], dtype=torch.long, device=input.device)
+            self.item_steps_skipped = torch.zeros([input.shape[0]], dtype=torch.long, device=input.device)
+        
+        active = self.active.nonzero().squeeze(1)
+        finished = (~self.active).nonzero().squeeze(1)
+        
+        if len(finished) == 0:
+            output = self.model(input, t, **kwargs)
+            denoised = self.get_denoised(input, output, t)
+        else:
+            output = torch.empty_like(input)
+            output[finished] = self.get_output(input[finished], self.previous[finished], t[finished])
+            self.steps_skipped += len(finished)
+            self.item_steps_skipped[finished] += 1
+            
+            if len(active) == 0:
+                return output
+            
+            output_active = self.model(input[active], t[active], **kwargs)
+            output[active] = output_active.to(output.dtype)
+            denoised = self.get_denoised(input[active], output_active, t[active])
+        
+        if self.previous is None:
+            self.previous = denoised.detach().clone()
+            return output
+        
+        change = (denoised - self.previous[active]).flatten(1).norm(dim=1) / denoised.flatten(1).norm(dim=1).clamp(min=1e-8)
+        stable_steps = torch.where(change < self.threshold, self.stable_steps[active] + 1, torch.zeros_like(change, dtype=torch.long))
+        
+        self.stable_steps[active] = stable_steps
+        self.previous[active] = denoised.detach().to(self.previous.dtype)
+        self.active[active] = stable_steps < self.patience
+        
+        return output
+    
+
+class FeatureCaching(torch.nn.Module):
+    """
+        Wraps a denoiser whose UNet contains `block`, a SkipBlock, and reuses the
+        deep features of its main branch across calls in the style of DeepCache.
+        Every `interval`-th call runs the full network and keeps those features, the
+        calls in between only run the levels above `block`. A call with a different
+        batch or length than the kept features always runs the full network.
+    """
+    def __init__(self, model, block, interval: int):
+        super().__init__()
+        self.model = model
+        self.block = block
+        self.interval = interval
+        
+        self.calls = 0
+        self.calls_reused = 0
+    
+    def forward(self, input, t, **kwargs):
+        reuse = self.calls % self.interval != 0
+        self.calls += 1
+        self.calls_reused += int(reuse)
+        
+        self.block.cache_main = True
+        self.block.reuse_main = reuse
+        
+        return self.model(input, t, **kwargs)
+    
+    def remove(self):
+        self.block.cache_main = False
+        self.block.reuse_main = False
+        self.block.cached_main = None
+    
+
+class RePaintSampling(torch.nn.Module):
+    """
+        Gradient-free inpainting in the style of RePaint: before every model call the
+        known region of the input (`mask` True) is replaced by `source` noised to the
+        current level with the fixed `noise`, and the known region of the returned
+        estimate is replaced by `source` itself, so any sampler steps it exactly onto
+        the source. With `resamples` > 1 the blended estimate is re-noised to the same
+        level with fresh noise from `noise_fn` and denoised again, which lets the
+        generated region harmonize with the known one at the cost of one extra model
+        call per resample.
+        
+        With `v_parameterization` the model returns v and takes t, otherwise it
+        returns the denoised estimate and takes sigma.
+    """
+    def __init__(self, model, source, mask, noise, resamples: int = 1, v_parameterization: bool = False, noise_fn=None):
+        super().__init__()
+        self.model = model
+        self.source = source
+        self.mask = mask
+        self.noise = noise
+        self.resamples = resamples
+        self.v_parameterization = v_parameterization
+        self.noise_fn = noise_fn if noise_fn is not None else torch.randn_like
+    
+    def forward(self, input, t, **kwargs):
+        if self.v_parameterization:
+            alpha, sigma = t_to_alpha_sigma(append_dims(t, input.ndim))
+        else:
+            alpha, sigma = 1.0, append_dims(t, input.ndim)
+        
+        known = self.source * alpha + self.noise * sigma
+        x = torch.where(self.mask, known, input)
+        
+        for resample in range(self.resamples):
+            output = self.model(x, t, **kwargs)
+            denoised = x * alpha - output * sigma if self.v_parameterization else output
+            
+            if resample < self.resamples - 1:
+                x = torch.where(self.mask, known, denoised * alpha + self.noise_fn(x) * sigma)
+        
+        denoised = torch.where(self.mask, self.source, denoised)
+        
+        if not self.v_parameterization:
+            return denoised
+        
+        # v for the sampler's own input, at sigma = 0 the estimate is the input itself
+        return torch.where(sigma > 0, (input * alpha - denoised) / sigma.clamp(min=1e-8), torch.zeros_like(input))
+    
+
 class PosteriorSampling(torch.nn.Module):
     def __init__(self, model, x_T, measurement, mask, scale):
         super().__init__()